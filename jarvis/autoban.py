@@ -7,7 +7,6 @@
 import arrow
 import collections
 import fnmatch
-import pyscp
 import re
 import threading
 
@@ -28,8 +27,7 @@ Ban = collections.namedtuple('Ban', 'names hosts status reason thread')
 
 
 def get_ban_list():
-    wiki = pyscp.wikidot.Wiki('05command')
-    soup = wiki('chat-ban-page')._soup
+    soup = core.shared_wiki('05command')('chat-ban-page')._soup
     tables = soup('table', class_='wiki-content-table')
     bans = {}
     for table in tables:
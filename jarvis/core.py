@@ -10,7 +10,11 @@ import functools
 import logbook
 import pathlib
 import pyscp
+import queue
 import re
+import requests
+import threading
+import time
 import yaml
 
 from playhouse import dataset
@@ -37,16 +41,87 @@ with open('config.yaml') as file:
 # Page Cache
 ###############################################################################
 
-wiki = pyscp.wikidot.Wiki('www.scp-wiki.net')
-wlwiki = pyscp.wikidot.Wiki('wanderers-library')
-stats_wiki = pyscp.wikidot.Wiki('scp-stats')
-stats_wiki.auth(config.wiki.name, config.wiki.password)
+WIKI_POOL_SIZE = 10
+WIKI_LOGIN_TTL = 1800
+_sessions = {}
+_logins = {}
+_sessions_lock = threading.Lock()
+
+
+def _session(site, auth):
+    with _sessions_lock:
+        if (site, auth) not in _sessions:
+            instance = pyscp.wikidot.Wiki(site)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=WIKI_POOL_SIZE, pool_maxsize=WIKI_POOL_SIZE)
+            instance.req.mount('http://', adapter)
+            instance.req.mount('https://', adapter)
+            _sessions[site, auth] = instance
+            if auth:
+                _logins[site] = [threading.Lock(), None]
+        instance = _sessions[site, auth]
+    if auth:
+        _login(site, instance)
+    return instance
+
+
+def _login(site, instance, force=False):
+    # logging in takes several requests, so it's done outside the global lock
+    with _logins[site][0]:
+        last = _logins[site][1]
+        if force or last is None or time.monotonic() - last > WIKI_LOGIN_TTL:
+            instance.auth(config.wiki.name, config.wiki.password)
+            _logins[site][1] = time.monotonic()
+
+
+def reauthorize(force=False):
+    """
+    Log the shared authorized wiki instances in again.
+
+    Only instances that logged in more than WIKI_LOGIN_TTL seconds ago are
+    affected, unless force is True. Used to keep the sessions from expiring,
+    and to recover from failed logins.
+    """
+    with _sessions_lock:
+        sessions = [k for k in _sessions.items() if k[0][1]]
+    for (site, _), instance in sessions:
+        try:
+            _login(site, instance, force)
+        except Exception as e:
+            log.exception(e)
+
+
+def shared_wiki(site):
+    """
+    Get a shared anonymous wiki instance.
+
+    Instances are created on first use and reused by all modules, keeping
+    their connections to the site alive between commands.
+    """
+    return _session(site, False)
+
+
+def authorized_wiki(site):
+    """
+    Get a shared wiki instance logged in with the bot's credentials.
+
+    Like shared_wiki, but the instance is logged in on creation, and again
+    once the login is older than WIKI_LOGIN_TTL, so that commands editing
+    the wiki do not have to log in on every call.
+    """
+    return _session(site, True)
+
+
+wiki = shared_wiki('www.scp-wiki.net')
+wlwiki = shared_wiki('wanderers-library')
+stats_wiki = authorized_wiki('scp-stats')
 
 
 def refresh():
     global pages
     global wlpages
     kwargs = dict(body='title created_by created_at rating tags', category='*')
+    wiki.metadata.cache_clear()
     if config.debug:
         db = dataset.DataSet('sqlite:///jarvis/tests/resources/snapshot.db')
         data = []
@@ -60,16 +135,123 @@ def refresh():
     else:
         data = wiki.list_pages(**kwargs)
         wiki.titles.cache_clear()
-    pages = ext.PageView(data)
-    wiki.metadata.cache_clear()
+    pages = _snapshot(wiki, data)
 
     if not config.debug:
-        wlpages = ext.PageView(wlwiki.list_pages(**kwargs))
+        wlpages = _snapshot(wlwiki, wlwiki.list_pages(**kwargs))
+
+
+def _snapshot(site, data):
+    """
+    Build the cached page view.
+
+    The attribution metadata of the whole site is fetched once and stored
+    in the page records, so that the commands using page authors never have
+    to rebuild it.
+    """
+    metadata = collections.defaultdict(list)
+    for i in site.metadata():
+        metadata[i.url].append(i)
+    records = [ext.PageRecord.from_page(p, metadata[p.url]) for p in data]
+    view = ext.PageView.columnar(records)
+    view.aggregate  # precompute the author list used by scp.guess_author
+    return view
 
 
 refresh()
 
 
+###############################################################################
+# Wiki Write Queue
+###############################################################################
+
+
+class TokenBucket:
+    """Rate limiter allowing short bursts of calls."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until the next call is allowed."""
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.time) * self.rate)
+                self.time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+class WriteQueue:
+    """
+    Background queue for outbound wiki writes.
+
+    Page edits, tag changes, forum posts and private messages are executed
+    in order by a single worker thread, rate limited with a token bucket
+    to stay within wikidot's limits. Failed calls are retried with
+    exponential backoff after logging in again, unless queued with
+    retry=False. If a callback is given, it's called with None once the
+    call succeeds, or with the last exception if it doesn't.
+    """
+
+    def __init__(self, rate, capacity, retries=3, backoff=10):
+        self.bucket = TokenBucket(rate, capacity)
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def put(self, func, *args, callback=None, retry=True, **kwargs):
+        self.queue.put((func, args, kwargs, callback, retry))
+
+    def call(self, func, *args, retry=True, **kwargs):
+        """
+        Make a rate limited call, and return its result.
+
+        Calls that are not safe to repeat, such as forum posts, must be made
+        with retry=False: a request that timed out might still have gone
+        through. Raises the last exception if all attempts fail.
+        """
+        attempts = self.retries + 1 if retry else 1
+        for attempt in range(attempts):
+            self.bucket.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == attempts - 1:
+                    raise
+                log.warning('Wiki write failed: {}'.format(e))
+            time.sleep(self.backoff * 2 ** attempt)
+            # the failure might be caused by an expired login
+            reauthorize(force=True)
+
+    def _work(self):
+        while True:
+            func, args, kwargs, callback, retry = self.queue.get()
+            try:
+                self.call(func, *args, retry=retry, **kwargs)
+                error = None
+            except Exception as e:
+                log.exception(e)
+                error = e
+            if callback:
+                try:
+                    callback(error)
+                except Exception as e:
+                    log.exception(e)
+
+
+writes = WriteQueue(rate=0.5, capacity=2)
+
+
 ###############################################################################
 # Core Functions
 ###############################################################################
@@ -133,6 +133,39 @@ class ChannelConfig(BaseModel):
     gibber = peewee.BooleanField(null=True)
 
 
+class Image(BaseModel):
+    """Database Image Table."""
+
+    url = peewee.CharField(index=True)
+    page = peewee.CharField(index=True)
+    category = peewee.CharField(index=True)
+    source = peewee.CharField(null=True)
+    status = peewee.CharField(null=True)
+    notes = peewee.TextField(null=True)
+    phash = peewee.CharField(null=True)
+
+
+class ImageClaim(BaseModel):
+    """Database Image Category Claim Table."""
+
+    category = peewee.CharField(index=True)
+    user = peewee.CharField()
+
+
+class ImageChange(BaseModel):
+    """Database Table of Image Changes not yet Saved to the Wiki."""
+
+    category = peewee.CharField(index=True)
+    comment = peewee.TextField()
+
+
+class Member(BaseModel):
+    """Database Wiki Member Table."""
+
+    name = peewee.CharField(unique=True)
+    page = peewee.IntegerField(index=True)
+
+
 ###############################################################################
 
 
@@ -148,7 +181,16 @@ def init(path):
     except peewee.OperationalError:
         pass
 
+    try:
+        migrator = playhouse.migrate.SqliteMigrator(db)
+        playhouse.migrate.migrate(
+            migrator.add_column(
+                'Image', 'phash', peewee.CharField(null=True)))
+    except peewee.OperationalError:
+        pass
+
     db.connect()
     db.create_tables([
         Tell, Message, Quote, Memo,
-        Subscriber, Restricted, Alert, ChannelConfig], safe=True)
+        Subscriber, Restricted, Alert, ChannelConfig,
+        Image, ImageClaim, ImageChange, Member], safe=True)
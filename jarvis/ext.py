@@ -7,22 +7,139 @@
 ###############################################################################
 
 import collections
+import operator
+import pyscp
+import re
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ###############################################################################
 
 
+Aggregate = collections.namedtuple(
+    'Aggregate', 'count rating average lowest highest first last authors')
+
+
+class PageRecord:
+    """
+    Compact read-only copy of a pyscp Page.
+
+    Records only hold the fields jarvis reads from the cached pages. They
+    have no per-instance __dict__ and no raw page body, and their strings are
+    interned, so that the repeated tag and author names are stored only once.
+    """
+
+    __slots__ = (
+        'name', 'url', 'title', 'rating', 'created', 'tags', 'metadata')
+
+    def __init__(self, name, url, title, rating, created, tags, metadata):
+        self.name = sys.intern(name)
+        self.url = sys.intern(url)
+        self.title = title
+        self.rating = rating
+        self.created = created
+        self.tags = frozenset(sys.intern(t) for t in tags)
+        self.metadata = {sys.intern(k): v for k, v in metadata.items()}
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, repr(self.url))
+
+    @classmethod
+    def from_page(cls, page, metadata=None):
+        """
+        Create a record from a pyscp page.
+
+        If the list of the attribution entries for the page is given, it is
+        used instead of the page's own metadata property, which has to search
+        through the attribution list of the whole site on every call.
+        """
+        if metadata is None:
+            metadata = page.metadata
+        else:
+            metadata = {i.user: i for i in metadata}
+            if 'author' not in {i.role for i in metadata.values()}:
+                metadata[page._raw_author] = pyscp.core.Metadata(
+                    page.url, page._raw_author, 'author', None)
+            metadata = {
+                k: v._replace(date=page.created)
+                if v.role == 'author' and not v.date else v
+                for k, v in metadata.items()}
+        return cls(
+            page.name, page.url, page.title, page.rating,
+            page.created, page.tags, metadata)
+
+    @property
+    def is_mainlist(self):
+        if 'scp-wiki' not in self.url or 'scp' not in self.tags:
+            return False
+        return bool(re.search(r'/scp-[0-9]{3,4}$', self.url))
+
+    # only relies on the metadata, so the pyscp implementation can be reused
+    build_attribution_string = pyscp.core.Page.build_attribution_string
+
+
+class PageStore:
+    """
+    Columnar snapshot of page data.
+
+    Ratings and creation dates are kept in numpy arrays, and each tag and
+    author is mapped to the sorted positions of its pages in the page list.
+    Filters build boolean masks from these only when evaluated, so PageView
+    filters are vectorized operations instead of attribute lookups on every
+    page, without keeping a full-length mask for every tag and author.
+    """
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.rating = numpy.array([p.rating for p in self.pages], dtype=int)
+        self.created = numpy.array([p.created for p in self.pages], dtype=str)
+
+        tags = collections.defaultdict(list)
+        authors = collections.defaultdict(list)
+        for idx, page in enumerate(self.pages):
+            for tag in page.tags:
+                tags[tag].append(idx)
+            for user in page.metadata:
+                authors[user].append(idx)
+        self.tags = {
+            k: numpy.array(v, dtype=numpy.int32) for k, v in tags.items()}
+        self.authors = {
+            k: numpy.array(v, dtype=numpy.int32) for k, v in authors.items()}
+
+    def mask(self, positions=()):
+        """Create a mask selecting pages with the given positions."""
+        mask = numpy.zeros(len(self.pages), dtype=bool)
+        mask[positions] = True
+        return mask
+
+    def tag(self, name):
+        return self.mask(self.tags.get(name, []))
+
+    def author(self, name):
+        return self.mask(self.authors.get(name, []))
+
+
 class PageView:
-    """Extended list of pyscp Pages."""
+    """Extended list of pyscp Pages or PageRecords."""
 
     ###########################################################################
     # Magic Methods
     ###########################################################################
 
-    def __init__(self, pages):
-        self.pages = list(pages)
+    def __init__(self, pages, store=None, mask=None):
+        self._pages = None if pages is None else list(pages)
+        self.store = store
+        self.mask = mask
+        self._aggregate = None
 
     def __len__(self):
-        return len(self.pages)
+        if self._pages is None:
+            return int(numpy.count_nonzero(self.mask))
+        return len(self._pages)
 
     def __eq__(self, other):
         return self.pages == other
@@ -33,6 +150,33 @@ class PageView:
     def __getitem__(self, index):
         return self.pages[index]
 
+    ###########################################################################
+    # Columnar Storage
+    ###########################################################################
+
+    @classmethod
+    def columnar(cls, pages):
+        """
+        Create a view backed by a columnar page store.
+
+        Falls back to a plain list-backed view if numpy is not installed.
+        """
+        if numpy is None:
+            return cls(pages)
+        store = PageStore(pages)
+        return cls(None, store, numpy.ones(len(store.pages), dtype=bool))
+
+    @property
+    def pages(self):
+        # store-backed views only build the list of pages when it's needed
+        if self._pages is None:
+            self._pages = [
+                self.store.pages[i] for i in numpy.flatnonzero(self.mask)]
+        return self._pages
+
+    def _masked(self, mask):
+        return self.__class__(None, self.store, self.mask & mask)
+
     ###########################################################################
     # Filter Methods
     ###########################################################################
@@ -42,6 +186,16 @@ class PageView:
         all_ = {t.lstrip('+') for t in tags if t.startswith('+')}
         none = {t.lstrip('-') for t in tags if t.startswith('-')}
         any_ = {t for t in tags if t[0] not in '-+'}
+        if self.store is not None:
+            mask = numpy.ones(len(self.mask), dtype=bool)
+            for t in all_:
+                mask &= self.store.tag(t)
+            for t in none:
+                mask &= ~self.store.tag(t)
+            if any_:
+                mask &= numpy.logical_or.reduce(
+                    [self.store.tag(t) for t in any_])
+            return self._masked(mask)
         pages = [
             p for p in self.pages if (p.tags >= all_) and not (p.tags & none)]
         if any_:
@@ -49,7 +203,10 @@ class PageView:
         return self.__class__(pages)
 
     def related(self, user, role=None):
-        pages = [p for p in self.pages if user in p.metadata]
+        if self.store is not None:
+            pages = self._masked(self.store.author(user)).pages
+        else:
+            pages = [p for p in self.pages if user in p.metadata]
         if role:
             pages = [p for p in pages if p.metadata[user].role == role]
         return self.__class__(pages)
@@ -69,6 +226,8 @@ class PageView:
         return self.__class__(results)
 
     def with_rating(self, rating):
+        if self.store is not None:
+            return self._masked(self._rating_mask(rating))
         pages = self.pages
         if rating.startswith('>'):
             rating = int(rating[1:])
@@ -84,7 +243,21 @@ class PageView:
             pages = [p for p in self.pages if p.rating == rating]
         return self.__class__(pages)
 
+    def _rating_mask(self, rating):
+        values = self.store.rating
+        if rating.startswith('>'):
+            return values > int(rating[1:])
+        elif rating.startswith('<'):
+            return values < int(rating[1:])
+        elif '..' in rating:
+            minr, maxr = map(int, rating.split('..'))
+            return (values >= minr) & (values <= maxr)
+        else:
+            return values == int(rating.lstrip('='))
+
     def created(self, created):
+        if self.store is not None:
+            return self._masked(self._created_mask(created))
         pages = self.pages
         if created.startswith('>'):
             pages = [p for p in self.pages if p.created > created[1:]]
@@ -101,6 +274,29 @@ class PageView:
                 p for p in self.pages if p.created.startswith(created)]
         return self.__class__(pages)
 
+    def _created_mask(self, created):
+        values = self.store.created
+
+        def crop(prefix):
+            return values.astype('U{}'.format(len(prefix)))
+
+        def within(bound, compare):
+            # an empty bound leaves that side of the range open
+            if not bound:
+                return numpy.ones(len(values), dtype=bool)
+            return compare(crop(bound), bound)
+
+        if created.startswith('>'):
+            return values > created[1:]
+        elif created.startswith('<'):
+            return values < created[1:]
+        elif '..' in created:
+            mincr, maxcr = created.split('..')
+            return (
+                within(mincr, operator.ge) & within(maxcr, operator.le))
+        else:
+            return crop(created) == created
+
     def sorted(self, key):
         pages = sorted(self.pages, key=lambda x: getattr(x, key))
         return self.__class__(pages)
@@ -140,22 +336,56 @@ class PageView:
     # Scalar End-Points
     ###########################################################################
 
+    @property
+    def aggregate(self):
+        """
+        Compute all scalar statistics of the view in a single pass.
+
+        The result is memoized, since views are never modified after
+        being created by the filter methods.
+        """
+        if self._aggregate is not None:
+            return self._aggregate
+
+        rating = 0
+        lowest = highest = first = last = None
+        authors = set()
+        for p in self.pages:
+            rating += p.rating
+            if lowest is None or p.rating < lowest.rating:
+                lowest = p
+            if highest is None or p.rating >= highest.rating:
+                highest = p
+            if first is None or p.created < first.created:
+                first = p
+            if last is None or p.created >= last.created:
+                last = p
+            authors.update(p.metadata)
+
+        count = len(self)
+        self._aggregate = Aggregate(
+            count=count,
+            rating=rating,
+            average=rating // count if count else 0,
+            lowest=lowest,
+            highest=highest,
+            first=first,
+            last=last,
+            authors=list(sorted(authors)))
+        return self._aggregate
+
     @property
     def count(self):
-        return len(self.pages)
+        return len(self)
 
     @property
     def rating(self):
-        if not self.pages:
-            return 0
-        return sum(p.rating for p in self.pages)
+        return self.aggregate.rating
 
     @property
     def authors(self):
-        return list(sorted({i for p in self.pages for i in p.metadata}))
+        return self.aggregate.authors
 
     @property
     def average(self):
-        if not self.pages:
-            return 0
-        return self.rating // self.count
+        return self.aggregate.average
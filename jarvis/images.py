@@ -5,28 +5,37 @@
 # Module Imports
 ###############################################################################
 
+import collections
+import concurrent.futures
 import functools
+import io
 import natural.number
-import pyscp
 import re
+import threading
 import time
 
-from . import core, parser, lex, utils
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+from . import core, parser, lex, utils, db, web
 
 
 ###############################################################################
 # Global Variables
 ###############################################################################
 
-wiki = pyscp.wikidot.Wiki('scp-stats')
-wiki.auth(core.config.wiki.name, core.config.wiki.password)
-
-scpwiki = pyscp.wikidot.Wiki('scp-wiki')
-scpwiki.auth(core.config.wiki.name, core.config.wiki.password)
+wiki = core.authorized_wiki('scp-stats')
+scpwiki = core.authorized_wiki('scp-wiki')
 
 
-IMAGES = []
 CLAIMS = {}
+DIRTY = collections.OrderedDict()
+SAVE_DELAY = 60
+SAVE_MAX_DELAY = 600
+SCAN_WORKERS = 8
+SIMILARITY = 10
 STATUS = [
     'PUBLIC DOMAIN',
     'BY-SA CC',
@@ -36,6 +45,7 @@ STATUS = [
     'SOURCE UNKNOWN',
     'UNABLE TO CONTACT',
     'PERMANENTLY REMOVED']
+CC_COMPATIBLE = ('PUBLIC DOMAIN', 'BY-SA CC')
 
 
 ###############################################################################
@@ -67,6 +77,9 @@ class Image:
         self.source = kwargs.get('source') or ''
         self.status = kwargs.get('status') or ''
         self.notes = kwargs.get('notes') or []
+        self.phash = kwargs.get('phash')
+        self.id = kwargs.get('id')
+        self._markup = None
 
     @property
     def url_t(self):
@@ -81,16 +94,309 @@ class Image:
         source = re.match(r'https*://(?:www\.)?([^/]+)', self.source)
         return source.group(1) if source else ''
 
+    def row(self):
+        """Get the values of the database record for the image."""
+        return dict(
+            url=self.url, page=self.page, category=self.category,
+            source=self.source, status=self.status,
+            notes='\n'.join(self.notes),
+            phash=None if self.phash is None else '{:016x}'.format(self.phash))
+
+    def markup(self):
+        """
+        Get the wikidot source of the image's rows in the index table.
+
+        The result is cached until the image record is updated.
+        """
+        if self._markup is not None:
+            return self._markup
+
+        img = '[[image {0.url} width="100px"]]'.format(self)
+        img = wtag('cell', img, rowspan=2)
+
+        page = wtag('cell', '[{} {}]'.format(self.page, self.page_t))
+
+        source = self.source_t
+        source = source and '[{} {}]'.format(self.source, source)
+        source = wtag('cell', source)
+
+        status = self.status.lower().replace(' ', '-')
+        status = '[[span class="{}"]]{}[[/span]]'.format(status, self.status)
+        status = wtag('cell', status)
+
+        notes = wtag('cell', ' _\n'.join(self.notes), colspan=4)
+
+        self._markup = '\n'.join([
+            wtag('row', img, page, source, status), wtag('row', notes)])
+        return self._markup
+
+
+def wtag(name, *data, **kwargs):
+    args = ' '.join('{}="{}"'.format(k, v) for k, v in kwargs.items())
+    head, tail = '[[{} {}]]'.format(name, args), '[[/{}]]'.format(name)
+    return '\n'.join([head] + list(data) + [tail])
+
+
+def fingerprint(url):
+    """
+    Compute the perceptual hash of the image.
+
+    Uses the difference hash: the image is shrunk to 9x8 grayscale pixels,
+    and each bit of the 64-bit hash shows whether a pixel is brighter than
+    its right neighbour. Similar-looking images have hashes that differ in
+    only a few bits. Returns None if the image can't be processed, or if
+    Pillow is not installed.
+    """
+    if PIL is None:
+        return None
+    try:
+        data = web.get(url, timeout=30).content
+        image = PIL.Image.open(io.BytesIO(data)).convert('L').resize((9, 8))
+    except Exception:
+        return None
+    pixels = list(image.getdata())
+    phash = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            phash = phash << 1 | (left > right)
+    return phash
+
+
+def hamming(x, y):
+    return bin(x ^ y).count('1')
+
+
+class BKTree:
+    """
+    Perceptual hashes arranged into a BK-tree.
+
+    Allows finding all the hashes within the given hamming distance from
+    the target without comparing it to every hash in the tree.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, phash, item):
+        node = (phash, [item], {})
+        if self.root is None:
+            self.root = node
+            return
+        parent = self.root
+        while True:
+            distance = hamming(phash, parent[0])
+            if distance == 0:
+                parent[1].append(item)
+                return
+            if distance not in parent[2]:
+                parent[2][distance] = node
+                return
+            parent = parent[2][distance]
+
+    def search(self, phash, radius):
+        """Get the items whose hashes are within radius from the target."""
+        results = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            value, items, children = nodes.pop()
+            distance = hamming(phash, value)
+            if distance <= radius:
+                results.extend(items)
+            nodes.extend(
+                v for k, v in children.items()
+                if distance - radius <= k <= distance + radius)
+        return results
+
+
+class ImageIndex:
+    """
+    Collection of image records.
+
+    Keeps lookup tables of the images by url, page url, page name and
+    category, which are updated whenever a record is added, changed, or
+    removed. For each page, it also counts the images whose license is not
+    compatible with the site's license.
+
+    The index is backed by the local database, and all changes are written
+    through to it. Image attributes must be changed via the update method,
+    to keep the lookup tables and the database consistent.
+
+    The index is used from several threads. All methods hold the lock, which
+    can also be held by the caller to make a series of changes atomic. The
+    time of the last change to each category is kept in the changed dict.
+    """
+
+    KEYS = ('url', 'page', 'page_t', 'category')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def __len__(self):
+        return len(self._images)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self._images.values()))
+
+    def clear(self):
+        with self.lock:
+            self._images = collections.OrderedDict()
+            self._tables = {
+                k: collections.defaultdict(collections.OrderedDict)
+                for k in self.KEYS}
+            self._unlicensed = collections.Counter()
+            self._hashes = BKTree()
+            self.changed = {}
+
+    def _index(self, image, key):
+        self._tables[key][getattr(image, key)][id(image)] = image
+
+    def _unindex(self, image, key, value):
+        table = self._tables[key]
+        del table[value][id(image)]
+        if not table[value]:
+            del table[value]
+
+    def _count_license(self, image, delta):
+        if image.status not in CC_COMPATIBLE:
+            self._unlicensed[image.page] += delta
+
+    def _lookup(self, key, value):
+        with self.lock:
+            if value not in self._tables[key]:
+                return []
+            return list(self._tables[key][value].values())
+
+    def _touch(self, *categories):
+        now = time.monotonic()
+        for category in categories:
+            self.changed[category] = now
+
+    def add(self, image, store=True):
+        with self.lock:
+            if store:
+                image.id = db.Image.create(**image.row()).id
+                self._touch(image.category)
+            self._images[id(image)] = image
+            for key in self.KEYS:
+                self._index(image, key)
+            self._count_license(image, 1)
+            if image.phash is not None:
+                self._hashes.add(image.phash, image)
+
+    def remove(self, image):
+        with self.lock:
+            db.Image.purge(id=image.id)
+            del self._images[id(image)]
+            for key in self.KEYS:
+                self._unindex(image, key, getattr(image, key))
+            self._count_license(image, -1)
+            self._touch(image.category)
+
+    def update(self, image, **kwargs):
+        with self.lock:
+            old = {k: getattr(image, k) for k in self.KEYS}
+            self._count_license(image, -1)
+            for attr, value in kwargs.items():
+                setattr(image, attr, value)
+            image._markup = None
+            row = {k: v for k, v in image.row().items() if k in kwargs}
+            db.Image.update(**row).where(db.Image.id == image.id).execute()
+            self._count_license(image, 1)
+            for key in self.KEYS:
+                if getattr(image, key) != old[key]:
+                    self._unindex(image, key, old[key])
+                    self._index(image, key)
+            if 'phash' in kwargs and image.phash is not None:
+                self._hashes.add(image.phash, image)
+            self._touch(old['category'], image.category)
+
+    def find(self, url):
+        """Get the image with the given url, if it's in the index."""
+        images = self._lookup('url', url)
+        return images[0] if images else None
+
+    def on_page(self, page):
+        """Get images on the page with the given url or name."""
+        return self._lookup('page', page) or self._lookup('page_t', page)
+
+    def in_category(self, category):
+        return self._lookup('category', category)
+
+    def compatible(self, page):
+        """Check if all images on the page have a compatible license."""
+        with self.lock:
+            return (
+                page in self._tables['page'] and not self._unlicensed[page])
+
+    def similar(self, image, radius=SIMILARITY):
+        """
+        Find near-duplicates of the image.
+
+        Returns (distance, image) pairs, closest first. The hash tree is
+        never pruned, so the matches are checked against the current state
+        of the index.
+        """
+        results = {}
+        with self.lock:
+            found = self._hashes.search(image.phash, radius)
+        for i in found:
+            if i is image or self._images.get(id(i)) is not i:
+                continue
+            distance = hamming(i.phash, image.phash)
+            if distance <= radius:
+                results[id(i)] = (distance, i)
+        return sorted(results.values(), key=lambda x: x[0])
+
+    def tracked(self, page):
+        """Get the urls of all indexed images on the page."""
+        return {i.url for i in self._lookup('page', page)}
+
+
+IMAGES = ImageIndex()
+
 
 def load_images():
-    global IMAGES
-    IMAGES = []
+    """Load the image index from the local database."""
+    IMAGES.clear()
+    for row in db.Image.all():
+        notes = [i for i in (row.notes or '').split('\n') if i]
+        phash = int(row.phash, 16) if row.phash else None
+        image = Image(
+            url=row.url, page=row.page, category=row.category,
+            source=row.source, status=row.status, notes=notes,
+            phash=phash, id=row.id)
+        IMAGES.add(image, store=False)
+    CLAIMS.clear()
+    CLAIMS.update({i.category: i.user for i in db.ImageClaim.all()})
+    with _save_lock:
+        DIRTY.clear()
+        for row in db.ImageChange.all():
+            DIRTY.setdefault(row.category, []).append((row.id, row.comment))
+        if DIRTY:
+            _schedule_save()
+
+
+def set_claim(category, user):
+    db.ImageClaim.purge(category=category)
+    if user:
+        db.ImageClaim.create(category=category, user=user)
+        CLAIMS[category] = user
+    else:
+        CLAIMS.pop(category, None)
+
+
+def scrape_images():
+    """Parse the image records and claims from the wiki index pages."""
+    images, claims = [], {}
     soup = wiki('images')._soup
     for category in soup(class_='collapsible-block'):
         name = category.find(class_='collapsible-block-link').text
         claim = category.find(class_='claim')
         if claim:
-            CLAIMS[name] = claim.text.split()[-1]
+            claims[name] = claim.text.split()[-1]
         rows = category('tr')
         for row, notes in zip(rows[::2], rows[1::2]):
             url, page, source, status = row('td')
@@ -100,56 +406,152 @@ def load_images():
             status = status.text
             notes = notes.find('td').text.split('\n')
             notes = [i for i in notes if i]
-            IMAGES.append(Image(url=url, page=page, category=name,
+            images.append(Image(url=url, page=page, category=name,
                                 source=source, status=status, notes=notes))
+    return images, claims
 
 
-def save_images(category, comment, user):
-
-    def wtag(name, *data, **kwargs):
-        args = []
-        for k, v in kwargs.items():
-            args.append('{}="{}"'.format(k, v))
-        result = ['[[{} {}]]'.format(name, ' '.join(args))]
-        result.extend(data)
-        result.append('[[/{}]]'.format(name))
-        return '\n'.join(result)
+def sync_images():
+    """
+    Import the changes made directly to the wiki index pages.
 
-    images = [i for i in IMAGES if i.category == category]
-    rows = []
-    for image in sorted(images, key=lambda x: x.page):
+    Only the records that differ between the wiki and the local database
+    are changed. The local database is the authoritative copy, so the
+    categories with changes not yet saved to the wiki, or changed after
+    the wiki pages were read, are left as they are.
 
-        img = '[[image {0.url} width="100px"]]'.format(image)
-        img = wtag('cell', img, rowspan=2)
+    Returns the number of added, updated and removed records, and the
+    number of skipped categories.
+    """
+    started = time.monotonic()
+    remote, claims = scrape_images()
+    with IMAGES.lock, db.db.atomic():
+        with _save_lock:
+            skip = set(DIRTY) | _writing
+        skip.update(k for k, v in IMAGES.changed.items() if v >= started)
+
+        added = updated = 0
+        for image in remote:
+            local = IMAGES.find(image.url)
+            if image.category in skip or (local and local.category in skip):
+                continue
+            if not local:
+                IMAGES.add(image)
+                added += 1
+                continue
+            changes = {
+                k: getattr(image, k)
+                for k in ('page', 'category', 'source', 'status', 'notes')
+                if getattr(image, k) != getattr(local, k)}
+            if changes:
+                IMAGES.update(local, **changes)
+                updated += 1
+
+        urls = {i.url for i in remote}
+        removed = [
+            i for i in IMAGES if i.url not in urls and i.category not in skip]
+        for image in removed:
+            IMAGES.remove(image)
+
+        for category in (set(CLAIMS) | set(claims)) - skip:
+            if CLAIMS.get(category) != claims.get(category):
+                set_claim(category, claims.get(category))
+
+    return added, updated, len(removed), len(skip)
+
+
+_save_lock = threading.Lock()
+_save_timer = None
+_writing = set()
+_dirty_since = None
+
+
+def _schedule_save():
+    global _save_timer, _dirty_since
+    now = time.monotonic()
+    if _dirty_since is None:
+        _dirty_since = now
+    delay = min(SAVE_DELAY, max(0, _dirty_since + SAVE_MAX_DELAY - now))
+    if _save_timer:
+        _save_timer.cancel()
+    _save_timer = threading.Timer(delay, flush_images)
+    _save_timer.daemon = True
+    _save_timer.start()
 
-        page = wtag('cell', '[{} {}]'.format(image.page, image.page_t))
 
-        source = image.source_t
-        source = source and '[{} {}]'.format(image.source, source)
-        source = wtag('cell', source)
+def save_images(category, comment, user):
+    """
+    Mark the category as changed and schedule the update of its page.
 
-        status = image.status.lower().replace(' ', '-')
-        status = '[[span class="{}"]]{}[[/span]]'.format(status, image.status)
-        status = wtag('cell', status)
+    The page is written only after no further changes were made for
+    SAVE_DELAY seconds, so that a series of edits to the same category
+    results in a single page write. Changes are never held back for more
+    than SAVE_MAX_DELAY seconds. Pending changes are kept in the database,
+    and are written after a restart.
+    """
+    comment = '{}. -{}'.format(comment, user)
+    with _save_lock:
+        row = db.ImageChange.create(category=category, comment=comment)
+        DIRTY.setdefault(category, []).append((row.id, comment))
+        _schedule_save()
 
-        notes = wtag('cell', ' _\n'.join(image.notes), colspan=4)
 
-        rows.append(wtag('row', img, page, source, status))
-        rows.append(wtag('row', notes))
+def flush_images():
+    """
+    Write all changed categories to the wiki.
 
-    source = []
+    Categories that fail to be written are marked as changed again, and
+    retried later.
+    """
+    global _dirty_since
+    with _save_lock:
+        dirty = list(DIRTY.items())
+        DIRTY.clear()
+        _writing.update(category for category, _ in dirty)
+        _dirty_since = None
+    failed = []
+    for category, changes in dirty:
+        comments = collections.OrderedDict.fromkeys(c for _, c in changes)
+        try:
+            write_category(category, ' '.join(comments))
+        except Exception as e:
+            core.log.exception(e)
+            failed.append(category)
+            with _save_lock:
+                DIRTY[category] = changes + DIRTY.get(category, [])
+            continue
+        finally:
+            # a sync that read the page before it was written mustn't
+            # import its old state
+            with IMAGES.lock:
+                IMAGES.changed[category] = time.monotonic()
+            with _save_lock:
+                _writing.discard(category)
+        db.ImageChange.delete().where(
+            db.ImageChange.id << [i for i, _ in changes]).execute()
+    if failed:
+        with _save_lock:
+            _schedule_save()
+    return len(dirty) - len(failed)
+
+
+def write_category(category, comment):
+    source = io.StringIO()
 
     if category in CLAIMS:
         claim = 'This category is maintained by **{}**'
         claim = claim.format(CLAIMS[category])
         claim = '[[span class="claim"]]{}[[/span]]'.format(claim)
-        source.append(claim)
+        source.write(claim + '\n')
 
-    source.append(wtag('table', *rows))
-    source = '\n'.join(source)
+    source.write('[[table ]]\n')
+    for image in sorted(IMAGES.in_category(category), key=lambda x: x.page):
+        source.write(image.markup() + '\n')
+    source.write('[[/table]]')
 
-    wiki('images:' + category).create(
-        source, category, comment='{}. -{}'.format(comment, user))
+    core.writes.call(
+        wiki('images:' + category).create,
+        source.getvalue(), category, comment=comment)
 
 
 def targeted(maxres=None):
@@ -158,12 +560,10 @@ def targeted(maxres=None):
 
         @functools.wraps(fn)
         def inner(inp, *args, target, index, **kwargs):
-            matches = []
-            for img in IMAGES:
-                if target in [img.page, img.page_t]:
-                    matches.append(img)
-                if img.url == target:
-                    return fn(inp, *args, images=[img], **kwargs)
+            img = IMAGES.find(target)
+            if img:
+                return fn(inp, *args, images=[img], **kwargs)
+            matches = IMAGES.on_page(target)
             if not matches:
                 inp.multiline = False
                 return lex.images.not_found
@@ -181,7 +581,7 @@ def targeted(maxres=None):
     return deco
 
 
-def get_page_category(page):
+def get_page_category(page, mainlist_links=None):
     if 'scp' in page.tags and re.match(r'.*scp-[0-9]+$', page.url):
         num = int(page.url.split('-')[-1])
         num = (num // 100) * 100
@@ -201,9 +601,21 @@ def get_page_category(page):
                 return v
         return 'U-Z'
 
-    if page.url in core.wiki('scp-001').links:
+    if mainlist_links is None:
+        mainlist_links = core.wiki('scp-001').links
+    if page.url in mainlist_links:
         return '001'
 
+
+def _scan_page(name, mainlist_links):
+    page = core.wiki(name)
+    category = get_page_category(page, mainlist_links)
+    if not category:
+        return page, None, []
+    urls = [i['src'] for i in page._soup.find(id='page-content')('img')]
+    hashes = {i: fingerprint(i) for i in urls if not IMAGES.find(i)}
+    return page, category, hashes
+
 ###############################################################################
 # Bot Commands
 ###############################################################################
@@ -229,20 +641,33 @@ def scan(inp, *, pages):
     """
     cats = set()
     counter = 0
-    for page in pages:
-        page = core.wiki(page)
-        cat = get_page_category(page)
-        if not cat:
-            yield lex.images.scan.unknown_category(page=page.name)
-            continue
-
-        for img in page._soup.find(id='page-content')('img'):
-            if any(i.url == img['src'] for i in IMAGES):
+    mainlist_links = set(core.wiki('scp-001').links)
+    with concurrent.futures.ThreadPoolExecutor(SCAN_WORKERS) as pool:
+        futures = {
+            pool.submit(_scan_page, i, mainlist_links): i for i in set(pages)}
+        done = concurrent.futures.as_completed(futures)
+        for idx, future in enumerate(done, start=1):
+            try:
+                page, cat, hashes = future.result()
+            except Exception as e:
+                core.log.exception(e)
+                yield lex.images.scan.failed(page=futures[future])
                 continue
-            img = Image(url=img['src'], page=page.url, category=cat)
-            IMAGES.append(img)
-            cats.add(cat)
-            counter += 1
+            if not cat:
+                yield lex.images.scan.unknown_category(page=page.name)
+                continue
+
+            for url, phash in hashes.items():
+                with IMAGES.lock:
+                    if IMAGES.find(url):
+                        continue
+                    IMAGES.add(Image(
+                        url=url, page=page.url, category=cat, phash=phash))
+                cats.add(cat)
+                counter += 1
+
+            if idx % 25 == 0 and idx < len(futures):
+                yield lex.images.scan.progress(done=idx, total=len(futures))
 
     for cat in cats:
         save_images(cat, 'added scan results', inp.user)
@@ -256,20 +681,16 @@ def scan(inp, *, pages):
 def update(inp, *, images, url, page, source, status, notes):
     """Update image records."""
     image = images[0]
-    if url:
-        image.url = url
-    if page:
-        image.page = page
-    if source:
-        image.source = source
-    if status:
-        if status not in STATUS and status != '-':
-            return lex.images.update.bad_status
-        image.status = status
+    if status and status not in STATUS and status != '-':
+        return lex.images.update.bad_status
+    if notes and image.notes:
+        return lex.images.update.notes_conflict
+
+    changes = dict(url=url, page=page, source=source, status=status)
+    changes = {k: v for k, v in changes.items() if v}
     if notes:
-        if image.notes:
-            return lex.images.update.notes_conflict
-        image.notes.append(notes)
+        changes['notes'] = [notes]
+    IMAGES.update(image, **changes)
 
     save_images(image.category, 'image updated', inp.user)
     return lex.images.update.done
@@ -295,12 +716,12 @@ def notes(inp, *, images, append, purge, list):
     image = images[0]
 
     if append:
-        image.notes.append(append)
+        IMAGES.update(image, notes=image.notes + [append])
         save_images(image.category, 'image notes appended', inp.user)
         return lex.images.notes.append
 
     if purge:
-        image.notes = []
+        IMAGES.update(image, notes=[])
         save_images(image.category, 'image notes purged', inp.user)
         return lex.images.notes.purge
 
@@ -316,8 +737,8 @@ def notes(inp, *, images, append, purge, list):
 @targeted()
 def purge(inp, *, images):
     """Delete all records of the image from the index."""
-    global IMAGES
-    IMAGES = [i for i in IMAGES if i not in images]
+    for image in images:
+        IMAGES.remove(image)
     save_images(images[0].category, 'records purged', inp.user)
     return lex.images.purge(count=len(images))
 
@@ -326,8 +747,26 @@ def purge(inp, *, images):
 @core.multiline
 @targeted(1)
 def search(inp, *, images):
-    """Return reverse-image-seach links for the image."""
+    """
+    Find duplicates of the image.
+
+    Lists the indexed images that look the same as the given one. If there
+    are none, returns reverse-image-search links for the image instead.
+    """
     image = images[0]
+    if image.phash is None:
+        phash = fingerprint(image.url)
+        if phash is not None:
+            IMAGES.update(image, phash=phash)
+
+    if image.phash is not None:
+        duplicates = IMAGES.similar(image)
+        if duplicates:
+            for distance, i in duplicates:
+                yield lex.images.search.duplicate(
+                    url=i.url, page=i.page, distance=distance)
+            return
+
     yield lex.images.search.tineye(url=image.url)
     yield lex.images.search.google(url=image.url)
 
@@ -335,7 +774,7 @@ def search(inp, *, images):
 @images.subcommand('stats')
 def stats(inp, *, category):
     """Show review statistics for an image category."""
-    images = [i for i in IMAGES if i.category == category]
+    images = IMAGES.in_category(category)
     return lex.images.stats(
         count=len(images),
         images=[i for i in images if i.status],
@@ -346,12 +785,38 @@ def stats(inp, *, category):
 @core.require(channel=core.config.irc.imageteam, level=2)
 def sync(inp):
     """
-    Reload image index.
+    Import manual changes from the index pages.
 
     Useful when the index page had to be manually edited for any reason.
+    Pending changes are saved to the wiki first, and then the wiki pages
+    are compared to the local index in the background. Categories that
+    still have unsaved changes are skipped.
+    """
+    def run():
+        try:
+            flush_images()
+            added, updated, removed, skipped = sync_images()
+        except Exception as e:
+            core.log.exception(e)
+            inp.send(lex.error)
+            return
+        inp.send(lex.images.sync.done(
+            added=added, updated=updated, removed=removed, skipped=skipped))
+
+    threading.Thread(target=run, daemon=True).start()
+    return lex.images.sync.started
+
+
+@images.subcommand('flush')
+@core.require(channel=core.config.irc.imageteam, level=2)
+def flush(inp):
+    """
+    Save pending changes to the index.
+
+    Changes to the index are written to the wiki after a short delay.
+    This subcommand writes them immediately.
     """
-    load_images()
-    return lex.images.sync
+    return lex.images.flush(count=flush_images())
 
 
 @images.subcommand('add')
@@ -375,35 +840,110 @@ def add(inp, *, url, page):
         page = page.group(1)
     page = core.wiki(page)
     category = get_page_category(page)
-    IMAGES.append(Image(url=url, page=page.url, category=category))
+    if not category:
+        return lex.images.add.unknown_category(page=page.name)
+    IMAGES.add(Image(url=url, page=page.url, category=category))
     save_images(category, 'image added', inp.user)
     return lex.images.add.done
 
 
-def remove_image_component(source, image_url):
-    name = image_url.split('/')[-1]
-    regex = r'(?is)\[\[include\s+component:image-block.*{}.*\]\]'
-    regex = regex.format(re.escape(name))
+IMAGE_BLOCK = re.compile(r'(?i)\[\[include\s+component:image-block')
+BRACKET = re.compile(r'[\[\]]')
 
-    bracketed = re.search(regex, source).group(0)
 
-    counter = 0
-    for idx, char in enumerate(bracketed):
-        if char == '[':
-            counter += 1
-        if char == ']':
-            counter -= 1
-        if counter == 0:
-            break
+def image_blocks(source):
+    """Yield (start, end) spans of all image-block includes in the source."""
+    pos = 0
+    while True:
+        match = IMAGE_BLOCK.search(source, pos)
+        if not match:
+            return
+        depth = 0
+        for bracket in BRACKET.finditer(source, match.start()):
+            depth += 1 if bracket.group() == '[' else -1
+            if depth == 0:
+                break
+        pos = bracket.end()
+        yield match.start(), pos
+
+
+def remove_image_components(source, image_urls):
+    """
+    Remove the image-blocks of all the given images in a single pass.
+
+    Returns the new source, and the set of the file names of the images
+    whose blocks were found.
+    """
+    names = {url.split('/')[-1].lower() for url in image_urls}
+    result, pos, matched = [], 0, set()
+    for start, end in image_blocks(source):
+        block = source[start:end].lower()
+        found = {name for name in names if name in block}
+        if found:
+            matched.update(found)
+            result.append(source[pos:start])
+            pos = end
+    result.append(source[pos:])
+    return ''.join(result), matched
+
+
+def _notify(inp, message):
+    """Create a write queue callback reporting the result to the channel."""
+    def callback(error):
+        inp.send(lex.error if error else message, multiline=False)
+    return callback
+
+
+def _queue_removal(inp, page, images, post, pm):
+    """
+    Queue the removal of the images from the page.
+
+    The page edit and the forum post are made by a single job, which stops
+    at the first failed step, or before editing the page if the code of any
+    of the images can't be found. Only once both succeed are the authors
+    notified, with a separate job for each message. Posts and messages are
+    never retried, so that they can't be sent twice.
+    """
+    page = scpwiki(page)
 
-    bracketed = bracketed[:idx + 1]
-    bracketed = re.escape(bracketed)
-    return re.sub(bracketed, '', source)
+    def send(message):
+        inp.send(message, multiline=False)
+
+    def remove_images():
+        source, matched = remove_image_components(page.source, images)
+        missing = [
+            i for i in images if i.split('/')[-1].lower() not in matched]
+        if missing:
+            send(lex.images.remove.not_found(images=missing))
+            return
+        core.writes.call(
+            page.edit, source, comment='removed image code. -' + inp.user)
+        send(lex.images.remove.page_edited)
+        core.writes.call(page._thread.new_post, post, retry=False)
+        send(lex.images.remove.posted)
+
+        text = pm(page)
+        authors = list(page.metadata)
+        counter = collections.Counter()
+
+        def report(error):
+            counter['failed' if error else 'sent'] += 1
+            if sum(counter.values()) == len(authors):
+                send(lex.error if counter['failed'] else
+                     lex.images.remove.pm_sent)
+
+        for user in authors:
+            core.writes.put(
+                scpwiki.send_pm, user, text, title='Image Removal',
+                retry=False, callback=report)
+
+    core.writes.put(
+        remove_images, retry=False,
+        callback=lambda error: error and send(lex.error))
 
 
 @images.subcommand('remove')
 @core.require(channel=core.config.irc.imageteam, level=2)
-@core.multiline
 def remove(inp, *, page, images):
     """
     Remove an image from the page.
@@ -419,28 +959,15 @@ def remove(inp, *, page, images):
     elements of the page except the image were removed, and that the
     formatting of the page is unaffected by the removal.
     """
-    page = scpwiki(page)
-
-    source = page.source
-    for i in images:
-        source = remove_image_component(source, i)
-    page.edit(source, comment='removed image code. -' + inp.user)
-    yield lex.images.remove.page_edited
-
-    time.sleep(5)
-
-    text = utils.load_template('image_removal_post', user=inp.user)
-    page._thread.new_post(text)
-    yield lex.images.remove.posted
+    post = utils.load_template('image_removal_post', user=inp.user)
 
-    time.sleep(5)
+    def pm(page):
+        return utils.load_template(
+            'image_removal_pm',
+            page=page.title, images='\n'.join(images), user=inp.user)
 
-    text = utils.load_template(
-        'image_removal_pm',
-        page=page.title, images='\n'.join(images), user=inp.user)
-    for i in page.metadata:
-        scpwiki.send_pm(i, text, title='Image Removal')
-    yield lex.images.remove.pm_sent
+    _queue_removal(inp, page, images, post, pm)
+    return lex.images.queued
 
 
 @images.subcommand('attribute')
@@ -456,7 +983,7 @@ def attribute(inp, *, page):
     """
     messages = []
     url = core.wiki(page).url
-    images = [i for i in IMAGES if i.page == url]
+    images = IMAGES.on_page(url)
 
     for idx, image in enumerate(images):
         if not image.source or not image.status:
@@ -484,8 +1011,12 @@ def attribute(inp, *, page):
     count = len(messages)
     messages.append(utils.load_template('attribution_postfix', user=inp.user))
     messages = '\n----\n'.join(messages)
-    scpwiki(page)._thread.new_post(messages, title='Image Attribution')
-    return lex.images.attribute.done(count=count)
+    core.writes.put(
+        lambda: scpwiki(page)._thread.new_post(
+            messages, title='Image Attribution'),
+        retry=False,
+        callback=_notify(inp, lex.images.attribute.done(count=count)))
+    return lex.images.queued
 
 
 @images.subcommand('claim')
@@ -497,14 +1028,14 @@ def claim(inp, *, category, purge):
     Adds a note on the index page indicating that the particular image
     category is being reviewed by the specific user.
     """
-    if not [i for i in IMAGES if i.category == category]:
+    if not IMAGES.in_category(category):
         return lex.images.claim.unknown_category
     if not purge:
-        CLAIMS[category] = inp.user
+        set_claim(category, inp.user)
         save_images(category, 'category claimed', inp.user)
         return lex.images.claim.done
     else:
-        CLAIMS.pop(category)
+        set_claim(category, None)
         save_images(category, 'category claim purged', inp.user)
 
 
@@ -520,34 +1051,38 @@ def tagcc(inp):
     the images on the page must be either licensed under the Public Domain
     or the BY-SA CC license.
     """
-    candidates = []
-    for page in {i.page for i in IMAGES}:
-        images = [i for i in IMAGES if i.page == page]
-        if all(i.status in ('PUBLIC DOMAIN', 'BY-SA CC') for i in images):
-            candidates.append(page)
-
-    if not candidates:
+    pages = [p for p in core.pages.tags('-_cc') if IMAGES.compatible(p.url)]
+    if not pages:
         yield lex.images.tagcc.no_candidates
         return
-
-    pages = [p for p in core.pages if p.url in candidates]
-    pages = [p for p in pages if '_cc' not in p.tags]
     yield lex.images.tagcc.working(count=len(pages))
 
-    count = 0
-    for page in pages:
-        images = [i.url for i in IMAGES if i.page == page.url]
-        if any(i not in images for i in page.images):
-            yield lex.images.tagcc.untracked(page=page.name)
-            continue
-
-        tags = page.tags
-        tags.add('_cc')
-        scpwiki(page.name).set_tags(tags)
-        time.sleep(2)
-        count += 1
+    counter = collections.Counter()
+
+    def tag(page):
+        images = IMAGES.tracked(page.url)
+        wikipage = scpwiki(page.name)
+        if any(i not in images for i in wikipage.images):
+            inp.send(
+                lex.images.tagcc.untracked(page=page.name), multiline=False)
+            return
+        wikipage.set_tags(page.tags | {'_cc'})
+        counter['tagged'] += 1
+
+    def report(error):
+        counter['done'] += 1
+        if counter['done'] == len(pages):
+            inp.send(
+                lex.images.tagcc.finished(count=counter['tagged']),
+                multiline=False)
+        elif counter['done'] % 25 == 0:
+            inp.send(
+                lex.images.tagcc.progress(
+                    done=counter['done'], total=len(pages)),
+                multiline=False)
 
-    yield lex.images.tagcc.finished(count=count)
+    for page in pages:
+        core.writes.put(tag, page, callback=report)
 
 
 #@core.command
@@ -558,36 +1093,23 @@ def unsourced(inp, mode, **kwargs):
 
 
 #@unsourced.subcommand('remove')
-@core.multiline
 def unsourced_remove(inp, *, page, images):
-    page = scpwiki(page)
-
-    source = page.source
-    for i in images:
-        source = remove_image_component(source, i)
-    page.edit(source, comment='removed image code. -' + inp.user)
-    yield lex.images.remove.page_edited
-
-    time.sleep(5)
-
-    text = lex.templates.unsourced.removal_post._raw
-    text += lex.templates.postfix._raw
-    text = text.format(user=inp.user)
-    page._thread.new_post(text)
-    yield lex.images.remove.posted
-
-    time.sleep(5)
+    post = lex.templates.unsourced.removal_post._raw
+    post += lex.templates.postfix._raw
+    post = post.format(user=inp.user)
 
-    text = lex.templates.unsourced.removal_pm._raw
-    text += lex.templates.postfix._raw
-    text = text.format(
-        page=page.title, images='\n'.join(images), user=inp.user)
-    for i in page.metadata:
-        scpwiki.send_pm(i, text, title='Image Removal')
-    yield lex.images.remove.pm_sent
+    def pm(page):
+        text = lex.templates.unsourced.removal_pm._raw
+        text += lex.templates.postfix._raw
+        return text.format(
+            page=page.title, images='\n'.join(images), user=inp.user)
 
+    _queue_removal(inp, page, images, post, pm)
+    return lex.images.queued
 
 
 ###############################################################################
 
 load_images()
+if not IMAGES:
+    sync_images()
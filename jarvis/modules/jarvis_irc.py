@@ -14,6 +14,7 @@ import arrow
 import functools
 import sopel
 import textwrap
+import threading
 
 import jarvis
 
@@ -44,6 +45,10 @@ def privileges(bot, nick):
     return {str(k).lower(): v[nick] for k, v in channels if nick in v}
 
 
+def setup(bot):
+    threading.Thread(target=jarvis.tools.sync_members, daemon=True).start()
+
+
 @sopel.module.rule('.*')
 def dispatcher(bot, tr):
     inp = jarvis.core.Inp(
@@ -56,9 +61,20 @@ def dispatcher(bot, tr):
 
 @sopel.module.interval(3600)
 def refresh(bot):
+    jarvis.core.reauthorize()
     jarvis.core.refresh()
 
 
+@sopel.module.interval(3600)
+def members(bot):
+    jarvis.tools.sync_members()
+
+
+@sopel.module.interval(86400)
+def steam(bot):
+    jarvis.websearch.STEAM.update()
+
+
 @sopel.module.interval(28800)
 def tweet(bot):
     jarvis.tools.post_on_twitter()
@@ -782,12 +782,15 @@ def showmore(pr):
                 starting with 1.""")
 
 
+DICE_THROW = re.compile(r'(?i)([+-]?[0-9]*)d([0-9]+|f)(!?)(?:k([0-9]+))?$')
+
+
 @parser
 def dice(pr):
     pr.add_argument(
         'throws',
         nargs='+',
-        re=r'(?i)[+-]?[0-9]*d([0-9]+|f)$',
+        re=DICE_THROW,
         type=str.lower,
         help="""One or more dice throws to be calculated.""")
 
@@ -824,10 +827,6 @@ def onpage(pr):
         action='join',
         help="""Wikidot username of the user in question.""")
 
-    pr.add_argument(
-        '--oldest-first', '-o',
-        help="""Start the search with oldest users.""")
-
 
 @parser
 def convert(pr):
@@ -1178,6 +1177,10 @@ def images(pr):
 
     pr.subparser('sync')
 
+    pr.subparser('flush')
+
+    ###########################################################################
+
     add = pr.subparser('add')
 
     add.add_argument(
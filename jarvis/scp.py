@@ -6,6 +6,7 @@
 ###############################################################################
 
 import arrow
+import concurrent.futures
 import functools
 import itertools
 import jinja2
@@ -51,8 +52,7 @@ def guess_author(func):
     @functools.wraps(func)
     def inner(inp, *args, **kwargs):
         text = (inp.text or inp.user).lower()
-        authors = {i for p in core.pages for i in p.metadata}
-        authors = sorted(i for i in authors if text in i.lower())
+        authors = [i for i in core.pages.authors if text in i.lower()]
 
         if not authors:
             return lex.author.not_found
@@ -84,16 +84,16 @@ def show_search_results(inp, results):
 def show_search_summary(inp, results):
     if not results:
         return lex.not_found.page
-    pages = ext.PageView(results).sorted('created')
+    stats = ext.PageView(results).aggregate
     return lex.search.summary(
-        count=pages.count,
-        authors=len(pages.authors),
-        rating=pages.rating,
-        average=pages.average,
-        first=arrow.get(pages[0].created).humanize(),
-        last=arrow.get(pages[-1].created).humanize(),
-        top_title=pages.sorted('rating')[-1].title,
-        top_rating=pages.sorted('rating')[-1].rating)
+        count=stats.count,
+        authors=len(stats.authors),
+        rating=stats.rating,
+        average=stats.average,
+        first=arrow.get(stats.first.created).humanize(),
+        last=arrow.get(stats.last.created).humanize(),
+        top_title=stats.highest.title,
+        top_rating=stats.highest.rating)
 
 
 def find_pages(
@@ -273,6 +273,34 @@ def errors(inp):
         yield lex.errors.done
 
 
+# wikidot starts throttling edits made in quick succession from the same
+# account, so the number of simultaneous page edits is kept low
+CLEANTITLES_WORKERS = 3
+
+
+def _clean_series_page(page, orphaned):
+    """
+    Remove orphaned titles from the series page source.
+
+    Returns the new source of the page, or None if it didn't change, and
+    the names of the titles that were removed or replaced.
+    """
+    purge = 'scp-series' not in page.url
+    source = page.source
+    lines, cleaned = [], set()
+    for line in source.split('\n'):
+        parsed = re.match(r'^\* \[\[\[([^\]]+)\]\]\] - .+$', line)
+        if not parsed or parsed.group(1).lower() not in orphaned:
+            lines.append(line)
+            continue
+        name = parsed.group(1)
+        cleaned.add(name.lower())
+        if not purge:
+            lines.append('* [[[{}]]] - [ACCESS DENIED]'.format(name))
+    lines = '\n'.join(lines)
+    return lines if lines != source else None, cleaned
+
+
 @core.command
 @core.require(channel=core.config.irc.sssc)
 @core.cooldown(7200)
@@ -285,34 +313,30 @@ def cleantitles(inp):
     """
     yield lex.cleantitles.start
 
-    pages = [
+    wiki = core.authorized_wiki('scp-wiki')
+    pages = [wiki(i) for i in [
         'scp-series', 'scp-series-2', 'scp-series-3', 'scp-series-4',
-        'joke-scps', 'scp-ex', 'archived-scps']
-    wiki = core.pyscp.wikidot.Wiki('scp-wiki')
-    wiki.auth(core.config.wiki.name, core.config.wiki.password)
-    orphaned = [p.url.split('/')[-1] for p in errors_orphaned()]
-
-    def clean_line(line, purge):
-        pattern = r'^\* \[\[\[([^\]]+)\]\]\] - .+$'
-        parsed = re.match(pattern, line)
-        if not parsed:
-            return line
-        name = parsed.group(1)
-        if name.lower() not in orphaned:
-            return line
-        if not purge:
-            return '* [[[{}]]] - [ACCESS DENIED]'.format(name)
-
-    for page in map(wiki, pages):
-        source = page.source.split('\n')
-        purge = 'scp-series' not in page.url
-        source = [clean_line(i, purge) for i in source]
-        source = [i for i in source if i is not None]
-        source = '\n'.join(source)
-        if source != page.source:
-            page.edit(source, comment='clean titles')
-
-    core.wiki.titles.cache_clear()
+        'joke-scps', 'scp-ex', 'archived-scps']]
+    orphaned = {p.url.split('/')[-1] for p in errors_orphaned()}
+
+    # the sources are read concurrently, but the edits share the rate limit
+    # and the backoff of the wiki write queue
+    with concurrent.futures.ThreadPoolExecutor(CLEANTITLES_WORKERS) as pool:
+        results = list(pool.map(
+            lambda x: _clean_series_page(x, orphaned), pages))
+
+    cleaned = set()
+    for page, (source, names) in zip(pages, results):
+        if source is not None:
+            core.writes.call(page.edit, source, comment='clean titles')
+        cleaned.update(names)
+
+    # patch the cached titles instead of re-crawling all the series pages;
+    # placeholder titles are skipped by the parser, so both the purged and
+    # the replaced titles are dropped
+    titles = core.wiki.titles()
+    for url in [k for k in titles if k.split('/')[-1] in cleaned]:
+        del titles[url]
     yield lex.cleantitles.end
 
 
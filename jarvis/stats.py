@@ -4,7 +4,6 @@
 # Module Imports
 ###############################################################################
 
-import pyscp
 import textwrap
 
 from dominate import tags as dt
@@ -209,9 +208,7 @@ class ArticlesTable(Chart):
 
 
 def update_user(name):
-    wiki = pyscp.wikidot.Wiki('scp-stats')
-    wiki.auth(core.config.wiki.name, core.config.wiki.password)
-    p = wiki('user:' + name.lower())
+    p = core.authorized_wiki('scp-stats')('user:' + name.lower())
 
     pages = sorted(
         core.pages.related(name),
@@ -44,3 +44,19 @@ def test_dispatcher_case_sensitivity():
 
 def test_dispatcher_leading_whitespace():
     assert not run(' .seen')
+
+
+def test_write_queue_no_retry():
+    writes = core.WriteQueue(rate=100, capacity=10, retries=2, backoff=0)
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise RuntimeError
+
+    for retry in (True, False):
+        try:
+            writes.call(fail, retry=retry)
+        except RuntimeError:
+            pass
+    assert len(calls) == 3 + 1
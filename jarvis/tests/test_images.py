@@ -26,3 +26,81 @@ def test_images_search():
 
 def test_images_stats_simple():
     assert run('.im stats 002-099') == lex.images.stats
+
+
+def test_image_index_update():
+    index = images.ImageIndex()
+    image = images.Image(
+        url='http://scp-wiki.wdfiles.com/local--files/scp-002/img.jpg',
+        page='http://www.scp-wiki.net/scp-001',
+        category='001')
+    index.add(image)
+    index.update(image, page='http://www.scp-wiki.net/scp-002')
+    assert index.on_page('scp-002') == [image]
+    assert not index.on_page('scp-001')
+    assert index.find(image.url) is image
+
+
+def test_image_index_compatible():
+    index = images.ImageIndex()
+    image = images.Image(
+        url='http://scp-wiki.wdfiles.com/local--files/scp-002/img.jpg',
+        page='http://www.scp-wiki.net/scp-002',
+        category='002-099')
+    index.add(image)
+    assert not index.compatible(image.page)
+    index.update(image, status='PUBLIC DOMAIN')
+    assert index.compatible(image.page)
+    index.remove(image)
+    assert not index.compatible(image.page)
+
+
+def test_image_markup_invalidated():
+    index = images.ImageIndex()
+    image = images.Image(
+        url='http://scp-wiki.wdfiles.com/local--files/scp-002/img.jpg',
+        page='http://www.scp-wiki.net/scp-002',
+        category='002-099',
+        status='PUBLIC DOMAIN')
+    index.add(image)
+    assert 'PUBLIC DOMAIN' in image.markup()
+    index.update(image, status='REPLACED')
+    assert 'PUBLIC DOMAIN' not in image.markup()
+    assert '[[span class="replaced"]]REPLACED[[/span]]' in image.markup()
+
+
+def test_remove_image_components():
+    source = (
+        'intro\n'
+        '[[include component:image-block name=a.jpg|caption=[[span]]A'
+        '[[/span]]]]\n'
+        '[[include component:image-block name=b.png|caption=B]]\n'
+        '[[include component:image-block name=c.gif|caption=C]]\n'
+        'outro')
+    result, matched = images.remove_image_components(source, [
+        'http://scp-wiki.wdfiles.com/local--files/scp-002/a.jpg',
+        'http://scp-wiki.wdfiles.com/local--files/scp-002/C.gif',
+        'http://scp-wiki.wdfiles.com/local--files/scp-002/d.jpg'])
+    assert result == (
+        'intro\n\n'
+        '[[include component:image-block name=b.png|caption=B]]\n\n'
+        'outro')
+    assert matched == {'a.jpg', 'c.gif'}
+
+
+def test_sync_images_skips_unsaved(monkeypatch):
+    index = images.ImageIndex()
+    kept, removed = [
+        images.Image(
+            url='http://scp-wiki.wdfiles.com/local--files/{}/img.jpg'.format(
+                page),
+            page='http://www.scp-wiki.net/' + page, category=category)
+        for page, category in (('scp-002', '002-099'), ('scp-100', '100-199'))]
+    index.add(kept)
+    index.add(removed)
+    monkeypatch.setattr(images, 'IMAGES', index)
+    monkeypatch.setattr(images, 'scrape_images', lambda: ([], {}))
+    monkeypatch.setitem(images.DIRTY, '002-099', [])
+    assert images.sync_images() == (0, 0, 1, 1)
+    assert index.in_category('002-099') == [kept]
+    assert not index.in_category('100-199')
@@ -4,7 +4,9 @@
 # Module Imports
 ###############################################################################
 
-from jarvis import scp, lex
+import pytest
+
+from jarvis import core, ext, scp, lex
 from jarvis.tests.utils import run, page
 
 ###############################################################################
@@ -102,6 +104,23 @@ def test_seach_created_year_and_month():
 def test_search_fullname():
     assert run('.s -f 1') == scp.show_page(page('1'))
 
+
+def test_search_summary():
+    assert run('.s -t keter --summary') == lex.search.summary(count=374)
+
+
+def test_columnar_page_view():
+    pytest.importorskip('numpy')
+    plain = ext.PageView(core.pages)
+    columnar = ext.PageView.columnar(core.pages)
+    for name, arg in [
+            ('tags', 'keter -tale'), ('tags', '+scp +euclid'),
+            ('with_rating', '>100'), ('with_rating', '10..20'),
+            ('created', '2014'), ('created', '2012-05..2013-01'),
+            ('created', '2014..'), ('created', '..2013-01'),
+            ('related', 'anqxyr')]:
+        assert getattr(columnar, name)(arg) == getattr(plain, name)(arg).pages
+
 ###############################################################################
 # Unused
 ###############################################################################
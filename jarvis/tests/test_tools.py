@@ -16,6 +16,25 @@ from jarvis.tests.utils import run
 ###############################################################################
 
 
+def test_result_store_budget():
+    store = tools.ResultStore(ttl=60, budget=10)
+    growing = []
+    store.save('#a', growing)
+    store.save('#b', [1, 2, 3])
+    growing.extend(range(9))
+    store.save('#c', [1])
+    assert store.get('#a') is None
+    assert store.size == 4
+
+
+def test_result_store_expired():
+    store = tools.ResultStore(ttl=-1, budget=10)
+    store.save('#a', [1])
+    store.ttl = 60
+    store.save('#b', [1])
+    assert list(store._data) == ['#b']
+
+
 ###############################################################################
 # Choose
 ###############################################################################
@@ -54,6 +73,18 @@ def test_dice_too_many_dice():
     assert run('.dice 1000000d10') == lex.dice.too_many_dice
 
 
+def test_dice_large_count():
+    assert run('.dice 50000d10') == lex.dice.output.simple
+
+
+def test_dice_keep_highest():
+    assert run('.dice 4d6k3') == lex.dice.output.simple
+
+
+def test_dice_exploding():
+    assert run('.dice 3d6! 2d4!k1') == lex.dice.output.simple
+
+
 def test_dice_too_many_sides():
     assert run('.roll 10d99999') == lex.dice.bad_side_count
 
@@ -126,7 +157,7 @@ def test_updatehelp():
 
 
 def test_onpage():
-    assert run('.onpage anqxyr -o') == [
+    assert run('.onpage anqxyr') == [
         lex.onpage.working,
         lex.onpage.found(user='anqxyr', page=15)]
 
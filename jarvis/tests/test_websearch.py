@@ -6,8 +6,10 @@
 ###############################################################################
 
 
-from jarvis import lex
-from jarvis.tests.utils import run
+import time
+
+from jarvis import lex, utils, websearch
+from jarvis.tests.utils import Inp, run
 
 
 ###############################################################################
@@ -89,6 +91,21 @@ def test_duckduckgo_showmore():
     assert run('.sm 8') == lex.duckduckgo.result(index=8)
 
 
+def test_duckduckgo_showmore_next():
+    run('.ddg scp-wiki')
+    run('.sm 3')
+    assert run('.sm') == lex.duckduckgo.result(index=4)
+
+
+def test_duckduckgo_showmore_after_shown():
+    run('.ddg scp-wiki')
+    assert run('.sm') == lex.duckduckgo.result(index=2)
+
+
+def test_metasearch_simple():
+    assert run('.ms scp foundation') == lex.metasearch.result
+
+
 ###############################################################################
 
 
@@ -116,6 +133,23 @@ def test_steam_no_genre():
     assert str(run('.steam magic the gathering'))
 
 
+def test_steam_catalog_find():
+    catalog = websearch.SteamCatalog(None)
+    catalog._index({
+        'terraria': 1, 'superhot': 2, 'superhot vr': 3,
+        'counter-strike: global offensive': 4, 'counter-strike': 5,
+        'magic: the gathering': 6, 'strike suit zero': 7})
+    assert catalog.find('terraria') == 1
+    assert catalog.find('super') == 2
+    assert catalog.find('strike') == 7
+    assert catalog.find('global offensive') == 4
+    assert catalog.find('strike: global') == 4
+    assert catalog.find('hot vr') == 3
+    assert catalog.find('magic the gathering') == 6
+    assert catalog.find('terarria') == 1
+    assert catalog.find('zzz') is None
+
+
 def test_steam_superhot():
     # this weird bug happens in cycles, every 3rd or so result is correct
     # so we'll check the output 3 times to make sure
@@ -184,3 +218,43 @@ def test_kaktuskast_title():
 def test_kaktuskast_sm():
     run('.kk')
     assert run('.sm 1') == lex.kaktuskast.long
+
+
+def test_result_cache_size_bound():
+    cache = utils.ResultCache(maxsize=10)
+    cache.put('a', 'x' * 4, 0)
+    cache.put('b', 'x' * 4, 0)
+    cache.get('a')
+    cache.put('c', 'x' * 4, 0)
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+    assert cache.size == 8
+
+
+def test_indexed_cache_stale():
+    fetched = []
+
+    @websearch.indexed_cache(ttl=60)
+    def cached(query):
+        fetched.append(query)
+        return [lex.metasearch.result(text='fresh')]
+
+    def text():
+        result = cached(inp, index=None, query='Test  Query')
+        return result.kwargs['text']
+
+    inp = Inp(None, 'test-user', '#test-channel', None, 4)
+    key = websearch._cache_key(cached, dict(query='test query'))
+    stale = websearch._dump_results([lex.metasearch.result(text='stale')])
+
+    websearch.SEARCH_CACHE.put(key, stale, time.time() - 30)
+    assert text() == 'stale'
+    for _ in range(100):
+        if fetched and key not in websearch._revalidating:
+            break
+        time.sleep(0.01)
+    assert text() == 'fresh'
+
+    websearch.SEARCH_CACHE.put(key, stale, time.time() - 90)
+    assert text() == 'fresh'
+    assert len(fetched) == 2
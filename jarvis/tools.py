@@ -7,13 +7,22 @@
 
 import arrow
 import bs4
+import collections
+import concurrent.futures
 import faker
 import functools
 import pint
 import random
+import threading
+import time
 import tweepy
 
-from . import core, parser, lex, __version__, utils
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import core, parser, lex, __version__, utils, db
 
 ###############################################################################
 # Global Variables
@@ -27,28 +36,103 @@ FAKE = faker.Faker()
 # Internal Tools
 ###############################################################################
 
-MEMORY = {}
+RESULT_TTL = 3600
+RESULT_BUDGET = 100000
+
+
+class ResultSet:
+    """Results of a single command, rendered one at a time when shown."""
+
+    def __init__(self, items, func, expires, shown=0):
+        self.items = items
+        self.func = func
+        self.expires = expires
+        self.cursor = shown
 
+    def __len__(self):
+        return len(self.items)
 
-def save_results(inp, items, func=None):
-    MEMORY[inp.channel] = items, func
+    def show(self, index=None):
+        """Render the item at the index, or the one after the last shown."""
+        index = self.cursor + 1 if index is None else index
+        item = self.items[index - 1]
+        self.cursor = index
+        return self.func(item) if self.func else item
+
+
+class ResultStore:
+    """
+    Results of the last command in each channel, for use with .showmore.
+
+    Entries expire after the ttl, and expired entries are dropped whenever
+    new results are saved. When the total number of stored items exceeds
+    the budget, the least recently used entries are dropped. The items are
+    counted when the budget is checked, since some commands keep adding to
+    their results after saving them.
+    """
+
+    def __init__(self, ttl, budget):
+        self.ttl = ttl
+        self.budget = budget
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return sum(len(i) for i in self._data.values())
+
+    def save(self, channel, items, func=None, shown=0):
+        with self._lock:
+            now = time.time()
+            self._data.pop(channel, None)
+            for key in [k for k, v in self._data.items() if v.expires < now]:
+                del self._data[key]
+            self._data[channel] = ResultSet(items, func, now + self.ttl, shown)
+            size = self.size
+            while size > self.budget and len(self._data) > 1:
+                size -= len(self._data.popitem(last=False)[1])
+
+    def get(self, channel):
+        with self._lock:
+            entry = self._data.get(channel)
+            if entry is not None and entry.expires < time.time():
+                del self._data[channel]
+                return None
+            if entry is not None:
+                self._data.move_to_end(channel)
+            return entry
+
+
+RESULTS = ResultStore(RESULT_TTL, RESULT_BUDGET)
+
+
+def save_results(inp, items, func=None, shown=0):
+    """
+    Save the results for the .showmore command.
+
+    If the command already showed the first few results, their number is
+    passed as shown, and .showmore without an index continues after them.
+    """
+    RESULTS.save(inp.channel, items, func, shown)
 
 
 @core.command
 @core.alias('sm')
 @parser.showmore
 def showmore(inp, *, index):
-    """Show additional results from the last used command."""
-    if index is None:
-        index = 1
-    if index <= 0:
+    """
+    Show additional results from the last used command.
+
+    Without an index, shows the result after the one shown last.
+    """
+    if index is not None and index <= 0:
         return lex.input.bad_index
-    if inp.channel not in MEMORY:
+    results = RESULTS.get(inp.channel)
+    if results is None:
         return lex.showmore.not_found
-    items, func = MEMORY[inp.channel]
-    if index > len(items):
+    if (index or results.cursor + 1) > len(results):
         return lex.showmore.index_error
-    return func(items[index - 1]) if func else items[index - 1]
+    return results.show(index)
 
 
 ###############################################################################
@@ -97,19 +181,62 @@ def choose(inp):
     return random.choice(options)
 
 
-def get_throw(count, sides):
-    if sides == 'f':
-        die = {-1: '\x034-\x0F', 0: '0', 1: '\x033+\x0F'}
-    else:
-        die = {i: str(i) for i in range(1, int(sides) + 1)}
+DICE_LIMIT = 100000
+DICE_SIDES = 5000
+DICE_SHOWN = 10
+FUDGE = {-1: '\x034-\x0F', 0: '0', 1: '\x033+\x0F'}
+
+
+def _roll(count, low, high):
+    """Roll all the dice of a throw in a single batch."""
+    if numpy is not None:
+        return numpy.random.randint(low, high + 1, size=count)
+    return [random.randint(low, high) for _ in range(count)]
+
+
+def _explode(results, low, high):
+    """Keep rerolling the dice that show the highest face."""
+    rolls = [results]
+    while True:
+        if numpy is not None:
+            extra = int((rolls[-1] == high).sum())
+        else:
+            extra = rolls[-1].count(high)
+        if not extra:
+            break
+        rolls.append(_roll(extra, low, high))
+    if numpy is not None:
+        return numpy.concatenate(rolls)
+    return [i for roll in rolls for i in roll]
+
+
+def get_throw(count, sides, keep=None, explode=False):
+    """
+    Roll the dice and return the total and the first few faces.
+
+    Exploding dice are rolled again each time they show the highest face.
+    If keep is given, only that many of the highest dice are counted.
+    """
+    low, high = (-1, 1) if sides == 'f' else (1, int(sides))
+    results = _roll(abs(count), low, high)
+
+    if explode:
+        results = _explode(results, low, high)
 
-    if count < 0:
-        count = -count
-        die = {-k: v for k, v in die.items()}
+    if keep is not None and keep < len(results):
+        if numpy is not None:
+            cut = len(results) - keep
+            results = numpy.partition(results, cut - 1)[cut:]
+        else:
+            results = sorted(results, reverse=True)[:keep]
 
-    results = [random.choice(list(die.keys())) for _ in range(count)]
-    total = sum(results)
-    expanded = ','.join(die[i] for i in results[:10])
+    total = int(results.sum() if numpy is not None else sum(results))
+    total = total if count > 0 else -total
+    shown = [int(i) for i in results[:DICE_SHOWN]]
+    if sides == 'f':
+        expanded = ','.join(FUDGE[i] for i in shown)
+    else:
+        expanded = ','.join(map(str, shown))
 
     return total, expanded
 
@@ -126,18 +253,21 @@ def dice(inp, *, throws, bonus, text, expand):
     d100 -10d5 +3d20
     3d20 +5 open the door
     3df 2d2
+    4d6k3 (keep the highest 3)
+    3d6! (exploding dice)
     """
     total = 0
     expanded = {}
 
     for throw in throws:
-        count, sides = throw.split('d')
-        count = int(count) if count else 1
-        if int(count) > 5000:
+        count, sides, explode, keep = parser.DICE_THROW.match(throw).groups()
+        count = int(count + '1' if count in ('', '+', '-') else count)
+        if abs(count) > DICE_LIMIT:
             return lex.dice.too_many_dice
-        if sides != 'f' and not 2 <= int(sides) <= 5000:
+        if sides != 'f' and not 2 <= int(sides) <= DICE_SIDES:
             return lex.dice.bad_side_count
-        subtotal, subexp = get_throw(count, sides)
+        subtotal, subexp = get_throw(
+            count, sides, keep=keep and int(keep), explode=bool(explode))
         total += subtotal
         expanded[throw] = subexp
 
@@ -308,7 +438,12 @@ def post_on_twitter():
 ###############################################################################
 
 
-@functools.lru_cache(maxsize=400)
+MEMBER_WORKERS = 4
+MEMBER_LOOKBACK = 5
+_members_lock = threading.Lock()
+_members_rebuild = threading.Lock()
+
+
 def _members_on_page(page):
     data = core.wiki._module('membership/MembersListModule', page=page)
     soup = bs4.BeautifulSoup(data['body'], 'lxml')
@@ -318,27 +453,120 @@ def _members_on_page(page):
     return int(total), authors
 
 
+def _add_members(page, members):
+    for idx in range(0, len(members), 100):
+        db.Member.insert_many([
+            dict(name=name, page=page)
+            for name in members[idx:idx + 100]]).execute()
+
+
+def _fill_members():
+    total, members = _members_on_page(1)
+    pages = range(2, total + 1)
+    with concurrent.futures.ThreadPoolExecutor(MEMBER_WORKERS) as pool:
+        found = pool.map(lambda x: _members_on_page(x)[1], pages)
+        found = [(1, members)] + list(zip(pages, found))
+
+    # the list can shift while it's being read, listing someone twice
+    seen = set()
+    with db.db.atomic():
+        db.Member.purge()
+        for page, members in found:
+            members = [i for i in members if i not in seen]
+            seen.update(members)
+            _add_members(page, members)
+
+
+def sync_members(full=False):
+    """
+    Add new wiki members to the member table.
+
+    The member list is ordered by join date, oldest members first, so new
+    members only ever appear on the last pages. These are read newest to
+    oldest until a page with an already known member is found. An empty
+    table, or a full sync, refills the whole table from all the pages,
+    fetched concurrently.
+    """
+    with _members_lock:
+        last = db.Member.select().order_by(db.Member.page.desc()).first()
+        if full or not last:
+            return _fill_members()
+
+        total, members = _members_on_page(last.page)
+        fetched = {last.page: members}
+        found = []
+        for page in range(total, 0, -1):
+            if page not in fetched:
+                fetched[page] = _members_on_page(page)[1]
+            known = db.Member.select(db.Member.name).where(
+                db.Member.name << fetched[page])
+            known = {i.name for i in known}
+            found.append((page, [i for i in fetched[page] if i not in known]))
+            if known:
+                break
+
+        with db.db.atomic():
+            for page, members in found:
+                _add_members(page, members)
+
+
+def _rebuild_members():
+    """Refill the member table in the background, unless already running."""
+    if not _members_rebuild.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            sync_members(full=True)
+        except Exception as e:
+            core.log.exception(e)
+        finally:
+            _members_rebuild.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _find_member(user):
+    """
+    Get the member list page of the user, or None.
+
+    The stored page is checked against the live member list. When accounts
+    leave the site, the list shifts back, so the few preceding pages are
+    checked as well. If the stored page turns out to be wrong, the table
+    is rebuilt in the background.
+    """
+    member = db.Member.find_one(name=user)
+    if not member:
+        return None
+    for page in range(member.page, max(member.page - MEMBER_LOOKBACK, 0), -1):
+        if user in _members_on_page(page)[1]:
+            break
+    else:
+        page = None
+    if page != member.page:
+        _rebuild_members()
+    return page
+
+
 @core.command
 @core.multiline
 @parser.onpage
-def onpage(inp, user, oldest_first):
+def onpage(inp, user):
     """
     Find the member list page on which the given user appears.
 
-    Iterates over the member lists until it find the required user.
-    Be default, starts with the newest members and continues back in time.
+    Looks the user up in the local member table, which is kept up to date
+    in the background, and confirms the page with a request or a few. If
+    the user is missing, the newest members are synced first.
     """
     yield lex.onpage.working
-    total, _ = _members_on_page(1)
-    pages = range(1, total + 1)
-    if not oldest_first:
-        pages = reversed(pages)
-
-    for page in pages:
-        if user in _members_on_page(page)[1]:
-            yield lex.onpage.found(user=user, page=page)
-            return
-    yield lex.onpage.not_found(user=user)
+    if not db.Member.find_one(name=user):
+        sync_members()
+    page = _find_member(user)
+    if page is not None:
+        yield lex.onpage.found(user=user, page=page)
+    else:
+        yield lex.onpage.not_found(user=user)
 
 
 @core.command
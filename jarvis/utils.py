@@ -4,7 +4,10 @@
 # Module Imports
 ###############################################################################
 
+import collections
 import jinja2
+import shelve
+import threading
 
 ###############################################################################
 # Jinja2
@@ -53,6 +56,60 @@ class AttrDict(dict):
 ###############################################################################
 
 
+class ResultCache:
+    """
+    Thread-safe LRU cache bounded by the total length of its values.
+
+    Values are strings, stored together with their expiration time. Expired
+    entries are kept until evicted, leaving it to the caller to decide how
+    long a stale value is still useful. If a path is given, the entries are
+    mirrored to a shelve database and survive restarts.
+    """
+
+    def __init__(self, maxsize, path=None):
+        self.maxsize = maxsize
+        self.size = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._shelf = shelve.open(path) if path else None
+        if self._shelf is not None:
+            # _insert may evict from the shelf, so don't iterate it directly
+            for key, entry in list(self._shelf.items()):
+                self._insert(key, entry)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _insert(self, key, entry):
+        if key in self._data:
+            self.size -= len(self._data.pop(key)[1])
+        self._data[key] = entry
+        self.size += len(entry[1])
+        while self.size > self.maxsize and len(self._data) > 1:
+            old, (_, value) = self._data.popitem(last=False)
+            self.size -= len(value)
+            if self._shelf is not None:
+                del self._shelf[old]
+
+    def get(self, key):
+        """Return the (expires, value) pair for the key, or None."""
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value, expires):
+        with self._lock:
+            self._insert(key, (expires, value))
+            if self._shelf is not None and key in self._data:
+                self._shelf[key] = (expires, value)
+                self._shelf.sync()
+
+
+###############################################################################
+
+
 def catch(exceptions, return_value=None):
 
     def decorator(func):
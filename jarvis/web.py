@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Shared HTTP client for all outbound requests."""
+
+###############################################################################
+# Module Imports
+###############################################################################
+
+import collections
+import requests
+import requests.adapters
+import threading
+import time
+import urllib.parse
+
+from requests.packages.urllib3.util.retry import Retry
+
+###############################################################################
+# Global Variables
+###############################################################################
+
+TIMEOUT = 15
+RETRIES = 3
+BACKOFF = 0.5
+POOL_SIZE = 10
+
+_sessions = {}
+_lock = threading.Lock()
+
+###############################################################################
+# Metrics
+###############################################################################
+
+
+class HostStats:
+    """Request count, error count and total latency for a single host."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+
+    def __repr__(self):
+        return '<{} {}/{} errors, {:.3f}s average>'.format(
+            self.__class__.__qualname__,
+            self.errors, self.requests, self.average)
+
+    @property
+    def average(self):
+        return self.latency / self.requests if self.requests else 0.0
+
+
+STATS = collections.defaultdict(HostStats)
+
+
+def _record(host, start, error):
+    with _lock:
+        stats = STATS[host]
+        stats.requests += 1
+        stats.errors += error
+        stats.latency += time.monotonic() - start
+
+
+###############################################################################
+# Requests
+###############################################################################
+
+
+def session(host):
+    """
+    Get the shared session for the host.
+
+    Each host gets its own keep-alive connection pool. Failed connections
+    and server errors are retried with exponential backoff.
+    """
+    with _lock:
+        if host not in _sessions:
+            retry = Retry(
+                total=RETRIES, backoff_factor=BACKOFF,
+                status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                max_retries=retry)
+            _sessions[host] = requests.Session()
+            _sessions[host].mount('http://', adapter)
+            _sessions[host].mount('https://', adapter)
+        return _sessions[host]
+
+
+def request(method, url, **kwargs):
+    """Make a request through the host's session, with a default timeout."""
+    host = urllib.parse.urlsplit(url).netloc
+    kwargs.setdefault('timeout', TIMEOUT)
+    start = time.monotonic()
+    try:
+        response = session(host).request(method, url, **kwargs)
+    except requests.RequestException:
+        _record(host, start, True)
+        raise
+    _record(host, start, response.status_code >= 500)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -5,47 +5,142 @@
 ###############################################################################
 
 import arrow
+import bisect
 import bs4
+import collections
+import concurrent.futures
+import contextlib
+import difflib
 import functools
 import googleapiclient.discovery
 import googleapiclient.errors
+import itertools
+import json
+import pathlib
+import queue
 import re
-import requests
+import threading
+import time
 import wikipedia as wiki
 import urllib.parse
 
-from . import core, parser, lex, tools, utils
+from . import core, parser, lex, tools, utils, web
 
 ###############################################################################
 
 
-def indexed_cache(func):
+SEARCH_CACHE = utils.ResultCache(
+    maxsize=4 * 2 ** 20, path=core.config.get('searchcache'))
+_revalidating = set()
+_revalidating_lock = threading.Lock()
 
-    func = functools.lru_cache()(func)
 
-    @functools.wraps(func)
-    @utils.catch(IndexError, return_value=lex.generics.index_error)
-    def inner(inp, *, index, **kwargs):
-        results = func(**kwargs)
-        if isinstance(results, list):
-            tools.save_results(inp, range(len(results)), results.__getitem__)
-            return results[index - 1 if index else 0]
-        else:
+def _cache_key(func, kwargs):
+    kwargs = {
+        k: ' '.join(v.lower().split()) if isinstance(v, str) else v
+        for k, v in kwargs.items()}
+    return '{}:{}'.format(func.__name__, json.dumps(kwargs, sort_keys=True))
+
+
+def _dump_results(results):
+    return json.dumps([[i.path, i.kwargs] for i in results])
+
+
+def _load_results(data):
+    return [
+        functools.reduce(getattr, path, lex)(**kwargs)
+        for path, kwargs in json.loads(data)]
+
+
+def indexed_cache(ttl):
+    """
+    Cache the search results and save them for the .showmore command.
+
+    Results are fresh for ttl seconds. For another ttl seconds after that,
+    the stale results are still shown, while being refreshed in the
+    background. Queries differing only in case and whitespace share results.
+    """
+
+    def decorator(func):
+
+        def fetch(key, kwargs):
+            results = func(**kwargs)
+            if isinstance(results, list):
+                SEARCH_CACHE.put(
+                    key, _dump_results(results), time.time() + ttl)
             return results
 
-    return inner
+        def revalidate(key, kwargs):
+            try:
+                fetch(key, kwargs)
+            finally:
+                with _revalidating_lock:
+                    _revalidating.discard(key)
+
+        @functools.wraps(func)
+        @utils.catch(IndexError, return_value=lex.generics.index_error)
+        def inner(inp, *, index, **kwargs):
+            key = _cache_key(func, kwargs)
+            entry = SEARCH_CACHE.get(key)
+            now = time.time()
+
+            if not entry or now > entry[0] + ttl:
+                results = fetch(key, kwargs)
+            else:
+                results = _load_results(entry[1])
+                with _revalidating_lock:
+                    stale = now > entry[0] and key not in _revalidating
+                    if stale:
+                        _revalidating.add(key)
+                if stale:
+                    threading.Thread(
+                        target=revalidate, args=(key, kwargs),
+                        daemon=True).start()
+
+            if isinstance(results, list):
+                tools.save_results(inp, results, shown=index or 1)
+                return results[index - 1 if index else 0]
+            else:
+                return results
+
+        return inner
+
+    return decorator
 
 
 ###############################################################################
 
 
+_services = {}
+
+
+@contextlib.contextmanager
+def _service(api, version):
+    """
+    Borrow a prebuilt service object for the given api.
+
+    Service objects and their http transports are not thread-safe, so each
+    one is used by a single thread at a time and then returned to the pool.
+    New ones are only built when all the existing ones are in use.
+    """
+    pool = _services.setdefault((api, version), queue.Queue())
+    try:
+        engine = pool.get_nowait()
+    except queue.Empty:
+        engine = googleapiclient.discovery.build(
+            api, version, developerKey=core.config.google.apikey)
+    try:
+        yield engine
+    finally:
+        pool.put(engine)
+
+
 def googleapi(api, version, method, _container='items', **kwargs):
-    engine = googleapiclient.discovery.build(
-        api, version, developerKey=core.config.google.apikey)
-    if method:
-        engine = getattr(engine, method)()
     try:
-        return engine.list(**kwargs).execute().get(_container)
+        with _service(api, version) as engine:
+            if method:
+                engine = getattr(engine, method)()
+            return engine.list(**kwargs).execute().get(_container)
     except googleapiclient.errors.HttpError as e:
         if e.resp.status in (500, 503):
             return lex.google.heavy_load
@@ -58,29 +153,37 @@ def googleapi(api, version, method, _container='items', **kwargs):
 @core.command
 @core.alias('g')
 @parser.google
-@indexed_cache
+@indexed_cache(ttl=86400)
 def google(query):
     """Ask the wise and all-knowing Google."""
-    results = googleapi(
-        'customsearch', 'v1', 'cse',
-        q=query, cx=core.config.google.cseid, num=10)
+    results = _google_results(query)
 
     if not results:
         return lex.google.not_found
+    if not isinstance(results, list):
+        return results
 
     return [
-        lex.google.result(
-            index=idx + 1,
-            total=len(results),
-            title=r['title'],
-            url=r['link'],
-            text=r['snippet'])
+        lex.google.result(index=idx + 1, total=len(results), **r)
         for idx, r in enumerate(results)]
 
 
+def _google_results(query):
+    results = googleapi(
+        'customsearch', 'v1', 'cse',
+        q=query, cx=core.config.google.cseid, num=10)
+
+    if not isinstance(results, list):
+        return results
+
+    return [
+        dict(title=r['title'], url=r['link'], text=r.get('snippet', ''))
+        for r in results]
+
+
 @core.command
 @parser.google
-@indexed_cache
+@indexed_cache(ttl=86400)
 def gis(query):
     """Search for images."""
     results = googleapi(
@@ -103,7 +206,7 @@ def gis(query):
 @core.command
 @core.alias('yt')
 @parser.youtube
-@indexed_cache
+@indexed_cache(ttl=21600)
 def youtube(query):
     """Search youtube for stuff."""
     results = googleapi(
@@ -114,23 +217,24 @@ def youtube(query):
         return lex.youtube.not_found
 
     video_ids = [r['id']['videoId'] for r in results]
+    info = _youtube_info(*video_ids)
+    video_ids = [i for i in video_ids if i in info]
     return [
         lex.youtube.result(
             index=idx + 1,
-            total=len(results),
+            total=len(video_ids),
             video_id=vid,
-            **info)
-        for idx, (vid, info) in
-        enumerate(zip(video_ids, _youtube_info(*video_ids)))]
+            **info[vid])
+        for idx, vid in enumerate(video_ids)]
 
 
 @core.rule(r'(?i).*youtube\.com/watch\?v=([-_a-z0-9]+)')
 @core.rule(r'(?i).*youtu\.be/([-_a-z0-9]+)')
 def youtube_lookup(inp):
-    info = _youtube_info(inp.text)
+    info = _youtube_batched(inp.text)
     if not info:
         return lex.youtube.not_found
-    return lex.youtube.result(**info[0])
+    return lex.youtube.result(**info)
 
 
 def _youtube_info(*video_ids):
@@ -138,7 +242,10 @@ def _youtube_info(*video_ids):
         'youtube', 'v3', 'videos',
         part='contentDetails,snippet,statistics', id=','.join(video_ids))
 
-    return [dict(
+    if not isinstance(results, list):
+        return {}
+
+    return {r['id']: dict(
         title=r['snippet']['title'],
         duration=r['contentDetails']['duration'][2:].lower(),
         likes=r.get('statistics', {}).get('likeCount'),
@@ -146,7 +253,43 @@ def _youtube_info(*video_ids):
         views=r.get('statistics', {}).get('viewCount'),
         channel=r['snippet']['channelTitle'],
         date=r['snippet']['publishedAt'][:10])
-        for r in results]
+        for r in results}
+
+
+YOUTUBE_BATCH_DELAY = 0.5
+_pending_videos = collections.OrderedDict()
+_pending_lock = threading.Lock()
+
+
+def _youtube_batched(video_id):
+    """
+    Get the info of a single video, batching lookups made close together.
+
+    The first lookup waits for a moment, then fetches all the videos
+    requested in the meantime with a single api call.
+    """
+    with _pending_lock:
+        leader = not _pending_videos
+        slot = _pending_videos.setdefault(video_id, [threading.Event(), None])
+
+    if leader:
+        time.sleep(YOUTUBE_BATCH_DELAY)
+        with _pending_lock:
+            batch = list(_pending_videos.items())
+            _pending_videos.clear()
+        for idx in range(0, len(batch), 50):
+            chunk = batch[idx:idx + 50]
+            try:
+                info = _youtube_info(*[vid for vid, _ in chunk])
+            except Exception as e:
+                core.log.exception(e)
+                info = {}
+            for vid, pending in chunk:
+                pending[1] = info.get(vid)
+                pending[0].set()
+
+    slot[0].wait()
+    return slot[1]
 
 
 ###############################################################################
@@ -156,7 +299,7 @@ def _youtube_info(*video_ids):
 @parser.translate
 def translate(inp, *, lang, query):
     """Powered by Yandex.Translate (http://translate.yandex.com/)."""
-    response = requests.get(
+    response = web.get(
         'https://translate.yandex.net/api/v1.5/tr.json/translate',
         params=dict(key=core.config.yandex, lang=lang, text=query))
 
@@ -181,26 +324,144 @@ def twitter_lookup(inp):
 @core.command
 @core.alias('ddg')
 @parser.duckduckgo
-@indexed_cache
+@indexed_cache(ttl=43200)
 def duckduckgo(query):
     """Ask the ducks if they know anything about the topic."""
-    response = requests.get(
+    results = _duckduckgo_results(query)
+
+    return [
+        lex.duckduckgo.result(index=idx + 1, total=len(results), **r)
+        for idx, r in enumerate(results)]
+
+
+def _duckduckgo_results(query):
+    response = web.get(
         'https://duckduckgo.com/html/', params={'q': query})
     soup = bs4.BeautifulSoup(response.text, 'html.parser')
-    results = soup(class_='web-result')
 
     return [
-        lex.duckduckgo.result(
-            index=idx + 1,
-            total=len(results),
+        dict(
             title=r.find(class_='result__a').text,
             url=r.find(class_='result__a')['href'],
             text=r.find(class_='result__snippet').text)
-        for idx, r in enumerate(results)]
+        for r in soup(class_='web-result')]
+
+
+###############################################################################
+# Steam
+###############################################################################
+
+
+STEAM_CATALOG = pathlib.Path('steamapps.json')
+STEAM_REFRESH = 86400
+STEAM_TTL = 86400
+STEAM_COMMON = 1000
+STEAM_WORD = re.compile(r'[^\W_]+')
+
+
+class SteamCatalog:
+    """
+    Index of steam app titles.
+
+    The app list is saved to disk, and loaded from there on restarts.
+    Titles are indexed for exact and prefix matches, and by the words they
+    contain for substring and fuzzy matches.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.apps = {}
+        self.names = []
+        self.words = {}
+        self.tokens = []
+        self._lock = threading.Lock()
+
+    def _index(self, apps):
+        words = collections.defaultdict(set)
+        for name in apps:
+            for word in STEAM_WORD.findall(name):
+                words[word].add(name)
+        self.apps, self.names = apps, sorted(apps)
+        self.words, self.tokens = words, sorted(words)
+
+    def update(self):
+        """Download the app list and rebuild the index."""
+        data = web.get(
+            'http://api.steampowered.com/ISteamApps/GetAppList/v0001/').json()
+        data = data['applist']['apps']['app']
+        apps = {i['name'].lower(): i['appid'] for i in data}
+        with self.path.open('w') as file:
+            json.dump(apps, file)
+        self._index(apps)
+
+    def load(self):
+        with self._lock:
+            if self.apps:
+                return
+            if not self.path.exists():
+                return self.update()
+            with self.path.open() as file:
+                self._index(json.load(file))
+            if time.time() - self.path.stat().st_mtime > STEAM_REFRESH:
+                threading.Thread(target=self.update, daemon=True).start()
+
+    def _prefixed(self, items, prefix):
+        idx = bisect.bisect_left(items, prefix)
+        return itertools.takewhile(lambda x: x.startswith(prefix), items[idx:])
+
+    def _with_words(self, title):
+        """Get the names with words starting with each word of the title."""
+        words = [
+            set().union(*[
+                self.words[i] for i in self._prefixed(self.tokens, word)])
+            for word in STEAM_WORD.findall(title)]
+        return set.intersection(*words) if words else set()
+
+    def _similar(self, title):
+        """Get the names with words similar to the words of the title."""
+        names = set()
+        for word in STEAM_WORD.findall(title):
+            tokens = list(self._prefixed(self.tokens, word[0]))
+            for token in difflib.get_close_matches(word, tokens, cutoff=0.75):
+                if len(self.words[token]) <= STEAM_COMMON:
+                    names |= self.words[token]
+        return names
+
+    def find(self, title):
+        """
+        Get the id of the app best matching the title, or None.
+
+        Tries exact, prefix and substring matches first, preferring the
+        shortest of several matching titles. Only if none are found are the
+        titles sharing similar words ranked by their similarity.
+        """
+        self.load()
+        if title in self.apps:
+            return self.apps[title]
+
+        names = list(self._prefixed(self.names, title))
+        if not names:
+            names = [i for i in self._with_words(title) if title in i]
+        if not names:
+            names = [i for i in self.names if title in i]
+        if names:
+            return self.apps[min(names, key=lambda x: (len(x), x))]
+
+        names = difflib.get_close_matches(
+            title, self._similar(title), n=1, cutoff=0.6)
+        return self.apps[names[0]] if names else None
+
+
+STEAM = SteamCatalog(STEAM_CATALOG)
 
 
 def get_steam_game(steam_id, url=True):
-    data = requests.get(
+    key = 'get_steam_game:{}:{}'.format(steam_id, url)
+    entry = SEARCH_CACHE.get(key)
+    if entry and entry[0] > time.time():
+        return _load_results(entry[1])[0]
+
+    data = web.get(
         'https://store.steampowered.com/api/appdetails',
         params={'appids': steam_id}).json()[str(steam_id)]
     if 'data' not in data:
@@ -213,9 +474,11 @@ def get_steam_game(steam_id, url=True):
     else:
         price = None
     genres = [i['description'] for i in data.get('genres', [])]
-    return lex.steam.result(
+    result = lex.steam.result(
         name=name, description=description, price=price,
         genres=genres, url=steam_id if url else None)
+    SEARCH_CACHE.put(key, _dump_results([result]), time.time() + STEAM_TTL)
+    return result
 
 
 @core.rule(r'https?://store.steampowered.com/app/([0-9]+)')
@@ -225,20 +488,12 @@ def steam_lookup(inp):
 
 @core.command
 @parser.steam
-def steam(inp, title, _cache={}):
+def steam(inp, title):
     """Find steam games by their title."""
-    if not _cache:
-        data = requests.get(
-            'http://api.steampowered.com/ISteamApps/GetAppList/v0001/').json()
-        data = data['applist']['apps']['app']
-        data = {i['name'].lower(): i['appid'] for i in data}
-        _cache.update(data)
-    if title in _cache:
-        return get_steam_game(_cache[title])
-    for k, v in _cache.items():
-        if title in k:
-            return get_steam_game(v)
-    return lex.steam.not_found
+    steam_id = STEAM.find(title)
+    if steam_id is None:
+        return lex.steam.not_found
+    return get_steam_game(steam_id)
 
 
 ###############################################################################
@@ -250,15 +505,27 @@ def steam(inp, title, _cache={}):
 def wikipedia(inp, *, query):
     """Get wikipedia page about the topic."""
     try:
-        page = wiki.page(query)
-    except wiki.exceptions.PageError:
-        return lex.wikipedia.not_found
+        results = _wikipedia_results(query)
     except wiki.exceptions.DisambiguationError as e:
         tools.save_results(inp, e.options, lambda x: wikipedia(inp, query=x))
         return lex.unclear(options=e.options)
 
-    return lex.wikipedia.result(
-        title=page.title, url=page.url, text=page.content)
+    if not results:
+        return lex.wikipedia.not_found
+    return lex.wikipedia.result(**results[0])
+
+
+def _wikipedia_results(query):
+    """
+    Get the wikipedia page about the topic.
+
+    Raises DisambiguationError if the topic is ambiguous.
+    """
+    try:
+        page = wiki.page(query)
+    except wiki.exceptions.PageError:
+        return []
+    return [dict(title=page.title, url=page.url, text=page.content)]
 
 
 @core.command
@@ -267,7 +534,7 @@ def wikipedia(inp, *, query):
 def dictionary(inp, *, query):
     """Look up dictionary definition of a word or a phrase."""
     url = 'http://ninjawords.com/' + query
-    soup = bs4.BeautifulSoup(requests.get(url).text, 'lxml')
+    soup = bs4.BeautifulSoup(web.get(url).text, 'lxml')
     word = soup.find(class_='word')
 
     if not word or not word.dl:
@@ -295,7 +562,7 @@ def urbandictionary(inp, *, query):
     if not inp.config.urbandict:
         return lex.urbandict.denied
     url = 'http://api.urbandictionary.com/v0/define?term=' + query
-    data = requests.get(url).json()
+    data = web.get(url).json()
     if not data['list']:
         return lex.not_found.generic
     result = data['list'][0]
@@ -309,7 +576,7 @@ def tvtropes(inp, *, query):
     query = query.title().replace(' ', '')
     baseurl = 'http://tvtropes.org/{}/' + query
     url = baseurl.format('Laconic')
-    soup = bs4.BeautifulSoup(requests.get(url).text, 'lxml')
+    soup = bs4.BeautifulSoup(web.get(url).text, 'lxml')
     text = soup.find(class_='page-content').find('hr')
     if text is None:
         return lex.tvtropes.not_found
@@ -318,26 +585,91 @@ def tvtropes(inp, *, query):
     text = [str(i).strip() for i in text]
     return '{} {}'.format(' '.join(text), baseurl.format('Main'))
 
+###############################################################################
+# Meta Search
+###############################################################################
+
+
+METASEARCH_DEADLINE = 10
+METASEARCH_BACKENDS = [
+    ('Google', _google_results),
+    ('DuckDuckGo', _duckduckgo_results),
+    ('Wikipedia', _wikipedia_results)]
+
+
+@core.command
+@core.alias('ms')
+@parser.websearch
+def metasearch(inp, *, query):
+    """
+    Search Google, DuckDuckGo and Wikipedia at the same time.
+
+    Shows the first result to arrive. Results from all the engines are
+    merged as they come in, and can be viewed with .showmore.
+    """
+    merged, seen = [], set()
+    lock = threading.Lock()
+
+    def search(source, backend):
+        try:
+            results = backend(query)
+        except wiki.exceptions.DisambiguationError:
+            return
+        except Exception as e:
+            core.log.exception(e)
+            return
+        if not isinstance(results, list):
+            return
+        with lock:
+            for r in results:
+                url = r['url'].rstrip('/')
+                if url not in seen:
+                    seen.add(url)
+                    merged.append(dict(r, source=source))
+
+    # the wikipedia library makes its requests without a timeout, so each
+    # call gets its own threads, and a hung lookup is left behind instead
+    # of holding up the searches that come after it
+    pool = concurrent.futures.ThreadPoolExecutor(len(METASEARCH_BACKENDS))
+    futures = [
+        pool.submit(search, source, backend)
+        for source, backend in METASEARCH_BACKENDS]
+    pool.shutdown(wait=False)
+    tools.save_results(
+        inp, merged, lambda x: lex.metasearch.result(**x), shown=1)
+
+    try:
+        for _ in concurrent.futures.as_completed(
+                futures, timeout=METASEARCH_DEADLINE):
+            with lock:
+                if merged:
+                    return lex.metasearch.result(**merged[0])
+    except concurrent.futures.TimeoutError:
+        pass
+    return lex.metasearch.not_found
+
 ###############################################################################
 # Kaktuskast
 ###############################################################################
 
 
+PODCAST_TTL = 600
+EPISODE_INDEX = [
+    re.compile(r'(?<=Ep\. )[0-9]+'),
+    re.compile(r'(?<=Episode )[0-9]+'),
+    re.compile(r'(?<=TTRIMMD )[0-9]+')]
+
+
 def _extract_episode_index(title):
-    index = re.findall('(?<=Ep\. )[0-9]+', title)
-    if not index:
-        index = re.findall('(?<=Episode )[0-9]+', title)
-    if not index:
-        index = re.findall('(?<=TTRIMMD )[0-9]+', title)
-    try:
-        return int(index[0])
-    except:
-        return None
+    for regex in EPISODE_INDEX:
+        index = regex.search(title)
+        if index:
+            return int(index.group(0))
+    return None
 
 
-def _parse_kk(url):
-    url = 'https://www.djkakt.us/' + url
-    soup = bs4.BeautifulSoup(requests.get(url).text, 'lxml')
+def _parse_kk(text):
+    soup = bs4.BeautifulSoup(text, 'lxml')
 
     episodes = []
     for epi in soup.find(class_='blog-list')('article'):
@@ -361,6 +693,52 @@ def _parse_kk(url):
     return episodes
 
 
+class PodcastFeed:
+    """
+    Parsed episodes of a single djkakt.us podcast.
+
+    The page is fetched on first use, and revalidated with conditional
+    requests once the parsed episodes are older than PODCAST_TTL. Stale
+    episodes are returned while the page is revalidated in the background.
+    """
+
+    def __init__(self, name):
+        self.url = 'https://www.djkakt.us/' + name
+        self.episodes = []
+        self.index = {}
+        self.etag = None
+        self.modified = None
+        self.checked = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            headers = {}
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.modified:
+                headers['If-Modified-Since'] = self.modified
+            response = web.get(self.url, headers=headers)
+            if response.status_code != 304:
+                episodes = _parse_kk(response.text)
+                self.etag = response.headers.get('ETag')
+                self.modified = response.headers.get('Last-Modified')
+                self.episodes = episodes
+                self.index = {i.index: i for i in reversed(episodes)}
+            self.checked = time.time()
+
+    def get(self):
+        if not self.checked:
+            self.refresh()
+        elif time.time() - self.checked > PODCAST_TTL:
+            if not self._lock.locked():
+                threading.Thread(target=self.refresh, daemon=True).start()
+        return self
+
+
+PODCASTS = {}
+
+
 def _find_podcast(substring):
     podcasts = {
         'kaktuskast': '',
@@ -389,26 +767,22 @@ def kaktuskast(inp, podcast, index):
     If episode index is provided, returns the detailed description of the
     episode. Otherwise, shows titles and links to the latest 3 episodes.
     """
+    podcast = _find_podcast(podcast) if podcast else 'kaktuskast'
     if not podcast:
-        episodes = _parse_kk('kaktuskast')
-    else:
-        podcast = _find_podcast(podcast)
-        if podcast:
-            episodes = _parse_kk(podcast)
-        else:
-            yield lex.kaktuskast.podcast_not_found
-            return
+        yield lex.kaktuskast.podcast_not_found
+        return
+    feed = PODCASTS.setdefault(podcast, PodcastFeed(podcast)).get()
+    episodes = feed.episodes
 
     if index:
-        candidates = [i for i in episodes if i.index == index]
-        if not candidates:
+        if index not in feed.index:
             yield lex.kaktuskast.index_error
             return
-        post = candidates[0]
+        post = feed.index[index]
         yield lex.kaktuskast.short(**post)
         yield lex.kaktuskast.text(**post)
     else:
         for epi in episodes[:3]:
             yield lex.kaktuskast.short(**epi)
         episodes = [lex.kaktuskast.long(**e) for e in episodes]
-        tools.save_results(inp, episodes)
+        tools.save_results(inp, episodes, shown=3)
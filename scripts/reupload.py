@@ -5,8 +5,6 @@
 ###############################################################################
 
 import jarvis
-import pyscp
-import requests
 import re
 import collections
 import time
@@ -14,8 +12,7 @@ import urllib.parse
 
 ###############################################################################
 
-wiki = pyscp.wikidot.Wiki('scp-wiki')
-wiki.auth(jarvis.core.config.wiki.name, jarvis.core.config.wiki.password)
+wiki = jarvis.core.authorized_wiki('scp-wiki')
 
 
 def reupload(page, *images):
@@ -26,7 +23,7 @@ def reupload(page, *images):
         return
     source = page.source
     for img in images:
-        data = requests.get(img).content
+        data = jarvis.web.get(img).content
         name = img.split('/')[-1]
         if not any(i.name == urllib.parse.unquote(name) for i in page.files):
             try:
@@ -46,4 +46,7 @@ setuptools.setup(
         'pint',
         'faker',
     ],
+    extras_require={
+        'columnar': ['numpy'],
+        'fingerprints': ['pillow']},
 )